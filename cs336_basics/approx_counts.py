@@ -0,0 +1,70 @@
+import collections
+
+# Approximate pre-token counting: trade a little fidelity of the merges for much smaller count tables.
+# Most unique pre-tokens of a web corpus occur once or twice and barely move the pair counts that pick
+# the top merges.
+#
+# Heavy hitters: a worker counts its text in blocks of at most `capacity` bytes, and after each block in
+# which its Counter grew past `capacity` distinct pre-tokens only the capacity // 2 most frequent survive
+# (halving, so pruning is amortized over many blocks). A block adds at most one pre-token per byte, so
+# the Counter never holds more than 2 * capacity entries (text without any safe split is read whole).
+# Every pruned pre-token had a count no larger than the smallest survivor, at most N / (capacity // 2)
+# for N pre-tokens counted so far, so a kept pre-token is undercounted by at most the sum of those
+# thresholds over the prunes, and any pre-token occurring more often than that total is kept.
+#
+# min_freq: pre-tokens seen fewer than min_freq times in the whole corpus are dropped before the pair
+# counts are built.
+
+
+def prune_to_capacity(counts: collections.Counter, capacity: int) -> int:
+    """
+    Keep the capacity // 2 most frequent entries of `counts` if it holds more than `capacity`. Returns
+    the largest count that was dropped (0 if nothing was).
+    """
+    if len(counts) <= capacity:
+        return 0
+    keep = counts.most_common(max(1, capacity // 2))
+    threshold = keep[-1][1]
+    counts.clear()
+    counts.update(dict(keep))
+    return threshold
+
+
+def apply_min_freq(w_counts, min_freq: int, special_tokens: set[str]) -> tuple[dict[bytes, int], int, int]:
+    """
+    The pre-tokens of `w_counts` seen at least `min_freq` times (special tokens always kept), plus the
+    number of unique pre-tokens and of occurrences dropped.
+    """
+    special_bytes = {s.encode("utf-8") for s in special_tokens}
+    kept = {}
+    dropped = dropped_total = 0
+    for word, count in w_counts.items():
+        if count >= min_freq or word in special_bytes:
+            kept[word] = count
+        else:
+            dropped += 1
+            dropped_total += count
+    return kept, dropped, dropped_total
+
+
+def merge_divergence(exact: list[tuple[bytes, bytes]], approx: list[tuple[bytes, bytes]],
+                     fractions=(0.1, 0.25, 0.5, 1.0)) -> dict:
+    """
+    How far `approx` merges drift from `exact` ones:
+    first_difference: index of the first differing merge (None if one is a prefix of the other)
+    overlap: {fraction: share of the first fraction of exact merges also among the first fraction of
+    approx merges}, as the top of the merge list matters most
+    mean_rank_shift: mean |rank difference| of the merges both lists contain
+    """
+    first = next((i for i, (a, b) in enumerate(zip(exact, approx)) if a != b), None)
+    overlap = {}
+    for frac in fractions:
+        n = max(1, int(len(exact) * frac))
+        overlap[frac] = len(set(exact[:n]) & set(approx[:n])) / n
+    approx_rank = {m: i for i, m in enumerate(approx)}
+    shifts = [abs(i - approx_rank[m]) for i, m in enumerate(exact) if m in approx_rank]
+    return {
+        "first_difference": first,
+        "overlap": overlap,
+        "mean_rank_shift": sum(shifts) / len(shifts) if shifts else 0.0,
+    }
@@ -0,0 +1,263 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+from pathlib import Path
+
+import regex as re
+
+from cs336_basics.approx_counts import merge_divergence
+from cs336_basics.bpe_engine import IntBPE, NumpyBPE
+from cs336_basics.bpe_stats import TrainStats
+from cs336_basics.pretokenization import PAT, pre_token_strings
+from cs336_basics.train_bpe import _work_slice, _merge_tuples, init_vocab, train_bpe
+from cs336_basics.utils import now, HERE
+
+FIXTURES = HERE.parent / "tests" / "fixtures"
+SPECIAL_TOKENS = ["<|endoftext|>"]
+BASELINE = HERE / "bench_baseline.json"
+GENERATED_DIR = Path(tempfile.gettempdir()) / "bpe_bench"
+
+# (corpus, vocab_size) pairs for the merge loop benchmark
+MERGE_CASES = [
+    ("corpus.en", 500),
+    ("corpus.en", 2000),
+    ("tinystories_sample.txt", 1000),
+]
+
+
+def _run_engine(engine, w_counts, special_tokens, max_merge):
+    if engine == "int":
+        return IntBPE(w_counts, special_tokens).run(max_merge)
+    if engine == "numpy":
+        return NumpyBPE(w_counts, special_tokens).run(max_merge)
+    return _merge_tuples(w_counts, special_tokens, max_merge)
+
+
+def bench_merge_loop(input_path, vocab_size, engine="int", special_tokens=SPECIAL_TOKENS, repeat=3):
+    """
+    Time only the merge loop (pre-tokenization is done once up front) and return the best
+    merges/sec over `repeat` runs.
+    """
+    specials = set(special_tokens)
+    w_counts = _work_slice(input_path, 0, os.path.getsize(input_path), specials)
+    max_merge = vocab_size - len(init_vocab(special_tokens))
+
+    best = float("inf")
+    num_merges = 0
+    for _ in range(repeat):
+        start = now()
+        num_merges = len(_run_engine(engine, w_counts, specials, max_merge))
+        best = min(best, now() - start)
+    return num_merges / best if best > 0 else float("inf")
+
+
+def bench_pre_tokenize(input_path, repeat=3) -> tuple[float, float]:
+    """
+    MB/s of the plain PAT regex and of pre_token_strings over `input_path` (special tokens left in,
+    they only add a few matches), best of `repeat` runs each.
+    """
+    text = Path(input_path).read_text(encoding="utf-8")
+    pat = re.compile(PAT)
+    rates = []
+    for scan in (pat.findall, pre_token_strings):
+        best = float("inf")
+        for _ in range(repeat):
+            start = now()
+            scan(text)
+            best = min(best, now() - start)
+        rates.append(len(text.encode("utf-8")) / (1 << 20) / best if best > 0 else float("inf"))
+    return rates[0], rates[1]
+
+
+# (corpus, vocab_size) pairs for the end-to-end train_bpe benchmark. "gen-<MB>" is a generated corpus
+# of about that many MB, see generate_corpus
+TRAIN_CASES = [
+    ("corpus.en", 500),
+    ("tinystories_sample.txt", 1000),
+    ("corpus.en", 2000),
+    ("gen-16", 1000),
+    ("gen-16", 5000),
+    ("gen-64", 10000),
+]
+QUICK_CASES = TRAIN_CASES[:2] + [("gen-4", 1000)]
+
+
+def generate_corpus(size_mb: int, seed: int = 0) -> Path:
+    """
+    Write (once) a corpus of about `size_mb` MB of documents separated by <|endoftext|>, built from the
+    words of the fixture corpora shuffled with a fixed seed, so every machine benchmarks the same bytes.
+    """
+    path = GENERATED_DIR / f"gen-{size_mb}-{seed}.txt"
+    if path.exists():
+        return path
+    words = []
+    for name in ("corpus.en", "tinystories_sample.txt"):
+        words += (FIXTURES / name).read_text(encoding="utf-8").split()
+    rng = random.Random(seed)
+    GENERATED_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".tmp{os.getpid()}")
+    with open(tmp, "w", encoding="utf-8") as f:
+        written = 0
+        while written < size_mb << 20:
+            doc = " ".join(rng.choices(words, k=rng.randint(50, 500))) + "\n" + SPECIAL_TOKENS[0] + "\n"
+            written += f.write(doc)
+    os.replace(tmp, path)
+    return path
+
+
+def _corpus_path(name: str) -> Path:
+    if name.startswith("gen-"):
+        return generate_corpus(int(name[len("gen-"):]))
+    return FIXTURES / name
+
+
+def bench_train(name: str, vocab_size: int, engine: str = "int",
+                **kwargs) -> tuple[dict, list[tuple[bytes, bytes]]]:
+    """
+    One train_bpe run: wall time, merges/sec, pre-tokenization MB/s and peak RSS (parent + workers),
+    and the merges it made.
+    """
+    input_path = _corpus_path(name)
+    stats = TrainStats(rss_interval=0.05)
+    start = now()
+    _, merges = train_bpe(input_path, vocab_size, SPECIAL_TOKENS, engine=engine, stats=stats, **kwargs)
+    wall = now() - start
+    pre_tokenize = sum(stats.phases.get(p, 0.0) for p in ("boundaries", "pre_tokenize", "reduce"))
+    merge_time = stats.phases.get("merges", 0.0)
+    result = {
+        "corpus": name,
+        "vocab_size": vocab_size,
+        "engine": engine,
+        "corpus_mb": os.path.getsize(input_path) / (1 << 20),
+        "wall_s": wall,
+        "merges_per_s": len(merges) / merge_time if merge_time else 0.0,
+        "pretokenize_mb_per_s": os.path.getsize(input_path) / (1 << 20) / pre_tokenize if pre_tokenize else 0.0,
+        "peak_rss_mb": max(stats.phase_rss.values(), default=0) / (1 << 20),
+        "pre_tokens": stats.pre_tokens,
+        "phases": stats.phases,
+    }
+    return result, merges
+
+
+# approximate settings compared against exact training by bench_approx
+APPROX_SETTINGS = [
+    {"min_freq": 2},
+    {"min_freq": 5},
+    {"max_pre_tokens": 20000},
+    {"max_pre_tokens": 5000, "min_freq": 3},
+]
+
+
+def bench_approx(name: str, vocab_size: int, settings=APPROX_SETTINGS) -> list[dict]:
+    """
+    Train exactly once, then with each approximate setting, and report time, pre-token table size and
+    how far the merges drift (approx_counts.merge_divergence).
+    """
+    exact, exact_merges = bench_train(name, vocab_size)
+    rows = []
+    for kwargs in settings:
+        r, merges = bench_train(name, vocab_size, **kwargs)
+        r["settings"] = kwargs
+        r["speedup"] = exact["wall_s"] / r["wall_s"] if r["wall_s"] else float("inf")
+        # peak RSS of runs in one process is not comparable (the allocator keeps freed memory), the size of
+        # the pre-token table handed to the merge loop is
+        r["pre_token_ratio"] = r["pre_tokens"] / exact["pre_tokens"] if exact["pre_tokens"] else 0.0
+        r["divergence"] = merge_divergence(exact_merges, merges)
+        rows.append(r)
+    return rows
+
+
+def _case_key(result: dict) -> str:
+    return f"{result['corpus']}@{result['vocab_size']}/{result['engine']}"
+
+
+# metric -> True if higher is better
+METRICS = {"wall_s": False, "merges_per_s": True, "pretokenize_mb_per_s": True, "peak_rss_mb": False}
+
+
+def compare_to_baseline(results: list[dict], baseline: list[dict], tolerance: float = 0.2) -> list[str]:
+    """
+    Every metric of every case that is more than `tolerance` (relative) worse than the same case in
+    `baseline`. Cases missing from the baseline are skipped.
+    """
+    base = {_case_key(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        old = base.get(_case_key(r))
+        if old is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            new_v, old_v = r[metric], old.get(metric)
+            if not old_v:
+                continue
+            worse = new_v < old_v / (1 + tolerance) if higher_is_better else new_v > old_v * (1 + tolerance)
+            if worse:
+                regressions.append(f"{_case_key(r)} {metric}: {old_v:.3f} -> {new_v:.3f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the BPE trainer")
+    parser.add_argument("--merge-loop", action="store_true", help="only time the merge loop of each engine")
+    parser.add_argument("--pre-tokenize", action="store_true", help="only compare PAT and the ASCII fast path")
+    parser.add_argument("--approx", action="store_true",
+                        help="only compare approximate counting (min_freq, max_pre_tokens) with exact training")
+    parser.add_argument("--quick", action="store_true", help="small cases only")
+    parser.add_argument("--out", help="write the results as JSON here")
+    parser.add_argument("--baseline", default=str(BASELINE), help="compare against this results file")
+    parser.add_argument("--write-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.merge_loop:
+        for name, vocab_size in MERGE_CASES:
+            for engine in ("tuple", "int", "numpy"):
+                rate = bench_merge_loop(FIXTURES / name, vocab_size, engine)
+                print(f"{name:<24} vocab={vocab_size:<6} engine={engine:<6} {rate:10.0f} merges/s")
+        return
+    if args.approx:
+        for name, vocab_size in (("corpus.en", 2000), ("gen-16", 5000)):
+            for r in bench_approx(name, vocab_size):
+                d = r["divergence"]
+                print(f"{name}@{vocab_size} {str(r['settings']):<40} {r['speedup']:5.2f}x faster "
+                      f"pre-tokens x{r['pre_token_ratio']:.2f} first diff {d['first_difference']} "
+                      f"top 10% overlap {d['overlap'][0.1]:.3f} all {d['overlap'][1.0]:.3f}")
+        return
+    if args.pre_tokenize:
+        for name in ("corpus.en", "tinystories_sample.txt", "german.txt", "gen-16"):
+            regex_rate, fast_rate = bench_pre_tokenize(_corpus_path(name))
+            print(f"{name:<24} PAT {regex_rate:7.1f} MB/s  fast path {fast_rate:7.1f} MB/s")
+        return
+
+    results = []
+    for name, vocab_size in QUICK_CASES if args.quick else TRAIN_CASES:
+        if not name.startswith("gen-") and not (FIXTURES / name).exists():
+            continue
+        r, _ = bench_train(name, vocab_size)
+        results.append(r)
+        print(f"{_case_key(r):<40} {r['corpus_mb']:7.1f} MB {r['wall_s']:8.2f}s "
+              f"{r['merges_per_s']:8.0f} merges/s {r['pretokenize_mb_per_s']:7.1f} MB/s "
+              f"peak RSS {r['peak_rss_mb']:7.1f} MB")
+
+    if args.out:
+        Path(args.out).write_text(json.dumps(results, indent=2))
+    if args.write_baseline:
+        Path(args.baseline).write_text(json.dumps(results, indent=2))
+        return
+    if not Path(args.baseline).exists():
+        # baselines are per machine, so none is committed: record one here first
+        print(f"no baseline at {args.baseline}, nothing compared; store one with --write-baseline",
+              file=sys.stderr)
+        sys.exit(2)
+    regressions = compare_to_baseline(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+    for line in regressions:
+        print("REGRESSION", line)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,580 @@
+import collections
+import functools
+import heapq
+import multiprocessing
+import os
+import pickle
+from array import array
+
+import numpy as np
+
+from cs336_basics.pretokenization import pack_counts, unpack_counts
+from cs336_basics.utils import now
+
+
+class _Desc:
+    """
+    Reverses the ordering of a pair so heapq (a min-heap) pops the lexicographically largest pair first.
+    """
+    __slots__ = ("pair",)
+
+    def __init__(self, pair):
+        self.pair = pair
+
+    def __lt__(self, other):
+        return self.pair > other.pair
+
+
+def pop_lazy_heap(heap: list, p_freq: dict):
+    """
+    Pop the key of the highest entry of a lazy max-heap of (-count, _Desc(pair), key) entries that is still
+    current, i.e. whose count matches p_freq[key]; None once the heap is exhausted. Changed counts are
+    pushed again rather than updated, so the stale entries are dropped here once they dominate the heap.
+    """
+    while heap:
+        neg_count, _, key = heapq.heappop(heap)
+        if p_freq.get(key) == -neg_count:
+            if len(heap) > 2 * len(p_freq) + 1024:
+                heap[:] = [e for e in heap if p_freq.get(e[2]) == -e[0]]
+                heapq.heapify(heap)
+            return key
+    return None
+
+
+def pack_pair(a: int, b: int) -> int:
+    return (a << 32) | b
+
+
+def unpack_pair(key: int) -> tuple[int, int]:
+    return key >> 32, key & 0xFFFFFFFF
+
+
+def local_merge_ids(ids: array, a: int, b: int, new_id: int, count: int, delta) -> array | None:
+    """
+    Merge (a, b) into new_id like train_bpe.merge(), recording the count changes of the pairs around
+    each merge site into `delta` (keyed by packed pair). Returns None when `ids` does not contain the pair.
+    """
+    updated = None
+    i = 0
+    n = len(ids)
+    while i < n:
+        if i < n - 1 and ids[i] == a and ids[i + 1] == b:
+            if updated is None:
+                updated = ids[:i]
+            delta[(a << 32) | b] -= count
+            if updated:
+                # the left token is new_id itself when the previous merge site is directly adjacent
+                delta[(ids[i - 1] << 32) | a] -= count
+                delta[(updated[-1] << 32) | new_id] += count
+            # a right neighbour that starts the next merge site is handled as that site's left side
+            if i + 2 < n and not (ids[i + 2] == a and i + 3 < n and ids[i + 3] == b):
+                delta[(b << 32) | ids[i + 2]] -= count
+                delta[(new_id << 32) | ids[i + 2]] += count
+            updated.append(new_id)
+            i += 2
+        else:
+            if updated is not None:
+                updated.append(ids[i])
+            i += 1
+    return updated
+
+
+class IntBPE:
+    """
+    Merge loop over interned integer ids instead of tuples of bytes.
+
+    Every pre-token gets a fixed word id holding an array('i') of token ids, so merging rewrites the
+    array in place of building new bytes and tuple keys. Pairs are packed into one int
+    ((a << 32) | b); token bytes are only looked up to break ties and to emit the merges.
+
+    pair2word maps a pair to an array('i') of word ids rather than a set: 4 bytes per entry instead of a
+    hash table per pair. Entries are never removed; a word that no longer holds the pair, or that is
+    listed twice, is skipped when the pair is merged, and the whole array is dropped then.
+    """
+
+    def __init__(self, w_counts: dict[bytes, int], special_tokens: set[str]):
+        self._init_words(w_counts, special_tokens)
+        self._build_index()
+
+    def _init_words(self, w_counts: dict[bytes, int], special_tokens: set[str]):
+        self._init_tokens()
+        self.words: list[array] = []
+        self.counts: list[int] = []
+
+        special_bytes = {s.encode("utf-8") for s in special_tokens}
+        for word, count in w_counts.items():
+            # special tokens and single bytes never contribute a pair
+            if word in special_bytes or len(word) < 2:
+                continue
+            self.words.append(array("i", list(word)))
+            self.counts.append(count)
+
+    def _init_tokens(self):
+        # token id -> bytes; 0..255 are the raw bytes, merged tokens are appended in merge order.
+        # Ids are unique per byte string: a merge producing bytes that already exist (e.g. (x, yz) after
+        # (xy, z)) reuses that id, so the pair counts match those of the tuple-of-bytes engine.
+        self.tokens: list[bytes] = [bytes([i]) for i in range(256)]
+        self.token_ids: dict[bytes, int] = {t: i for i, t in enumerate(self.tokens)}
+        self.merges: list[tuple[bytes, bytes]] = []
+
+    def _token_id(self, token: bytes) -> int:
+        tid = self.token_ids.get(token)
+        if tid is None:
+            tid = len(self.tokens)
+            self.tokens.append(token)
+            self.token_ids[token] = tid
+        return tid
+
+    def _build_index(self):
+        self._count_pairs()
+        self._build_heap()
+
+    def _count_pairs(self):
+        self.p_freq: dict[int, int] = collections.defaultdict(int)
+        self.pair2word: dict[int, array] = collections.defaultdict(functools.partial(array, "i"))
+        p_freq, pair2word = self.p_freq, self.pair2word
+        for wid, ids in enumerate(self.words):
+            count = self.counts[wid]
+            for a, b in zip(ids[:-1], ids[1:]):
+                key = (a << 32) | b
+                p_freq[key] += count
+                wids = pair2word[key]
+                # a pair repeated within the word is listed once: its last entry is this word
+                if not wids or wids[-1] != wid:
+                    wids.append(wid)
+
+    def _build_heap(self):
+        self.heap = [(-count, _Desc(self._pair_bytes(key)), key) for key, count in self.p_freq.items()]
+        heapq.heapify(self.heap)
+
+    @classmethod
+    def from_merges(cls, w_counts: dict[bytes, int], special_tokens: set[str],
+                    merges: list[tuple[bytes, bytes]]) -> "IntBPE":
+        """
+        Rebuild the state reached after `merges` without running the merge loop: every word is segmented
+        by replaying the merges in order, as a tokenizer would. Used to extend an existing vocab/merges.
+        """
+        self = cls.__new__(cls)
+        self._init_words(w_counts, special_tokens)
+        # packed pair -> [(rank, new id)]; a pair can be merged again if it reappears after its first merge
+        ranks: dict[int, list[tuple[int, int]]] = collections.defaultdict(list)
+        for rank, (a, b) in enumerate(merges):
+            key = pack_pair(self._token_id(a), self._token_id(b))
+            ranks[key].append((rank, self._token_id(a + b)))
+            self.merges.append((a, b))
+
+        unused = collections.defaultdict(int)
+        for wid, ids in enumerate(self.words):
+            last = -1
+            while len(ids) > 1:
+                # the next merge the training loop would have applied to this word: the lowest rank
+                # after the last one applied among its current pairs
+                best = None
+                for x, y in zip(ids[:-1], ids[1:]):
+                    for rank, new_id in ranks.get((x << 32) | y, ()):
+                        if rank > last and (best is None or rank < best[0]):
+                            best = (rank, x, y, new_id)
+                if best is None:
+                    break
+                last, x, y, new_id = best
+                ids = local_merge_ids(ids, x, y, new_id, 0, unused)
+            self.words[wid] = ids
+
+        self._build_index()
+        return self
+
+    def state_dict(self) -> dict:
+        # words are flattened into one id array plus offsets: pickling millions of small arrays is slow
+        offsets = array("q", [0])
+        flat = array("i")
+        for ids in self.words:
+            flat.extend(ids)
+            offsets.append(len(flat))
+        return {
+            "tokens": self.tokens,
+            "merges": self.merges,
+            "ids": flat,
+            "offsets": offsets,
+            "counts": array("q", self.counts),
+        }
+
+    @classmethod
+    def from_state_dict(cls, state: dict) -> "IntBPE":
+        """
+        Restore an IntBPE from state_dict(). Pair counts and pair2word are rebuilt from the words,
+        which costs the same as the initial pair count and keeps the checkpoint small.
+        """
+        self = cls.__new__(cls)
+        self.tokens = list(state["tokens"])
+        self.token_ids = {t: i for i, t in enumerate(self.tokens)}
+        self.merges = list(state["merges"])
+        flat, offsets = state["ids"], state["offsets"]
+        self.words = [flat[i:j] for i, j in zip(offsets, offsets[1:])]
+        self.counts = list(state["counts"])
+        self._build_index()
+        return self
+
+    def _pair_bytes(self, key: int) -> tuple[bytes, bytes]:
+        a, b = unpack_pair(key)
+        return self.tokens[a], self.tokens[b]
+
+    def _push(self, key: int):
+        heapq.heappush(self.heap, (-self.p_freq[key], _Desc(self._pair_bytes(key)), key))
+
+    def _pop(self) -> int | None:
+        return pop_lazy_heap(self.heap, self.p_freq)
+
+    def _next_merge(self) -> tuple[int, int] | None:
+        # pop the most frequent pair and register the merge: returns (packed pair, id of the merged token)
+        key = self._pop()
+        if key is None:
+            return None
+        a, b = unpack_pair(key)
+        pair = (self.tokens[a], self.tokens[b])
+        self.merges.append(pair)
+        return key, self._token_id(pair[0] + pair[1])
+
+    def _apply_merge(self, key: int, new_id: int, delta: dict[int, int]):
+        # rewrite every word containing `key` and record the pair count changes into `delta`
+        a, b = unpack_pair(key)
+        pair2word = self.pair2word
+        words, counts = self.words, self.counts
+        # a merged pair never comes back, so its word list is dropped; dict.fromkeys skips repeated words
+        for wid in dict.fromkeys(pair2word.pop(key, ())):
+            merged = local_merge_ids(words[wid], a, b, new_id, counts[wid], delta)
+            # pair2word is pruned lazily: a word whose pair was already merged away is skipped here
+            if merged is None:
+                continue
+            words[wid] = merged
+            for x, y in zip(merged[:-1], merged[1:]):
+                if x == new_id or y == new_id:
+                    wids = pair2word[(x << 32) | y]
+                    if not wids or wids[-1] != wid:
+                        wids.append(wid)
+
+    def _commit_delta(self, delta: dict[int, int]):
+        p_freq = self.p_freq
+        for k, d in delta.items():
+            if not d:
+                continue
+            p_freq[k] += d
+            if p_freq[k] == 0:
+                del p_freq[k]
+            else:
+                self._push(k)
+
+    def step(self) -> tuple[bytes, bytes] | None:
+        """
+        Pick the most frequent pair, apply it to every word containing it and return it as bytes.
+        Returns None when no pair is left.
+        """
+        picked = self._next_merge()
+        if picked is None:
+            return None
+        delta = collections.defaultdict(int)
+        self._apply_merge(*picked, delta)
+        self._commit_delta(delta)
+        return self.merges[-1]
+
+    def run(self, max_merge: int, checkpoint_path=None, checkpoint_every: int = 1000,
+            extra_state: dict | None = None, stats=None) -> list[tuple[bytes, bytes]]:
+        """
+        Merge until `max_merge` merges have been made in total (counting merges restored from a checkpoint
+        or replayed by from_merges) and return all of them. With `checkpoint_path`, the state is saved
+        every `checkpoint_every` merges and once at the end; `extra_state` is stored alongside.
+        `stats` (a bpe_stats.TrainStats) gets a merge-rate sample every stats.sample_every merges.
+        """
+        start = now()
+        sample_every = stats.sample_every if stats is not None else 0
+        while len(self.merges) < max_merge:
+            if self.step() is None:
+                break
+            if checkpoint_path is not None and len(self.merges) % checkpoint_every == 0:
+                save_checkpoint(checkpoint_path, self, extra_state)
+            if sample_every and len(self.merges) % sample_every == 0:
+                stats.merge_samples.append((len(self.merges), now() - start))
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, self, extra_state)
+        if stats is not None:
+            stats.merge_samples.append((len(self.merges), now() - start))
+        return self.merges
+
+
+def _shard_worker(conn, packed):
+    """
+    Merge loop worker for ShardedBPE: owns the words of one shard, sends its initial pair counts, then for
+    every (packed pair, new id) received applies the merge to its words and sends back the count deltas.
+    """
+    shard = IntBPE.__new__(IntBPE)
+    shard._init_words(unpack_counts(packed), set())
+    del packed
+    shard._count_pairs()
+    conn.send(dict(shard.p_freq))
+    del shard.p_freq  # the coordinator owns the global counts
+    while (msg := conn.recv()) is not None:
+        delta = collections.defaultdict(int)
+        shard._apply_merge(*msg, delta)
+        conn.send({k: d for k, d in delta.items() if d})
+    conn.close()
+
+
+class ShardedBPE(IntBPE):
+    """
+    IntBPE with the words split across `num_shards` worker processes. Each worker keeps the words and
+    pair2word of its shard and applies every merge to them; the coordinator only sums the per-shard count
+    deltas into the global pair counts and picks the next merge from its heap, so the merges are exactly
+    those of IntBPE. run() rejects a checkpoint_path, since the words live in the workers.
+    """
+
+    def __init__(self, w_counts: dict[bytes, int], special_tokens: set[str], num_shards: int):
+        self._init_tokens()
+        special_bytes = {s.encode("utf-8") for s in special_tokens}
+        shards: list[dict[bytes, int]] = [{} for _ in range(num_shards)]
+        loads = [0] * num_shards
+        # longest words first onto the least loaded shard, to balance the merge work
+        for word, count in sorted(w_counts.items(), key=lambda item: len(item[0]), reverse=True):
+            if word in special_bytes or len(word) < 2:
+                continue
+            i = loads.index(min(loads))
+            shards[i][word] = count
+            loads[i] += len(word)
+
+        self.conns = []
+        self.procs = []
+        for shard in shards:
+            parent_conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_shard_worker, args=(child_conn, pack_counts(shard)), daemon=True)
+            proc.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.procs.append(proc)
+        del shards
+
+        self.p_freq = collections.defaultdict(int)
+        for conn in self.conns:
+            for k, c in conn.recv().items():
+                self.p_freq[k] += c
+        self._build_heap()
+
+    def step(self) -> tuple[bytes, bytes] | None:
+        picked = self._next_merge()
+        if picked is None:
+            return None
+        for conn in self.conns:
+            conn.send(picked)
+        delta = collections.defaultdict(int)
+        for conn in self.conns:
+            for k, d in conn.recv().items():
+                delta[k] += d
+        self._commit_delta(delta)
+        return self.merges[-1]
+
+    def run(self, max_merge: int, checkpoint_path=None, checkpoint_every: int = 1000,
+            extra_state: dict | None = None, stats=None) -> list[tuple[bytes, bytes]]:
+        if checkpoint_path is not None:
+            raise ValueError("ShardedBPE does not support checkpoints: its words live in the shard workers")
+        return super().run(max_merge, stats=stats)
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+            conn.close()
+        for proc in self.procs:
+            proc.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def non_overlapping(hit: np.ndarray) -> np.ndarray:
+    """
+    The occurrences of a pair (a, a) a left-to-right merge applies, from `hit` marking every position
+    that starts one: in a run like a a a only every other occurrence merges, counting from its left end.
+    """
+    pos = np.arange(len(hit))
+    run_start = np.maximum.accumulate(np.where(hit & ~np.concatenate(([False], hit[:-1])), pos, 0))
+    return hit & ((pos - run_start) % 2 == 0)
+
+
+# merges touching fewer words than this go word by word (see NumpyBPE._apply_merge_words)
+VECTORIZE_MIN_WORDS = 64
+
+
+class NumpyBPE(IntBPE):
+    """
+    IntBPE with the words in flat numpy arrays and the pair work vectorized: `ids` holds every word's
+    token ids (int32) back to back, word w in ids[offsets[w]:offsets[w] + lengths[w]] (a word shrinks in
+    place as it is merged, leaving its tail unused), with its count in `counts`.
+
+    Initial pair counting is one np.unique + np.bincount over the packed (a << 32) | b codes of all
+    adjacent ids. A merge gathers the words pair2word lists for the pair into one array, replaces the
+    non-overlapping occurrences with vectorized masks, scatters the words back and takes the count delta
+    as (pairs after) - (pairs before) over just those words. Heap and tie-breaking are IntBPE's, so the
+    merges are identical.
+    """
+
+    def _init_words(self, w_counts: dict[bytes, int], special_tokens: set[str]):
+        self._init_tokens()
+        special_bytes = {s.encode("utf-8") for s in special_tokens}
+        words, counts = [], []
+        for word, count in w_counts.items():
+            # special tokens and single bytes never contribute a pair
+            if word in special_bytes or len(word) < 2:
+                continue
+            words.append(word)
+            counts.append(count)
+        self.lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+        self.offsets = np.zeros(len(words), dtype=np.int64)
+        np.cumsum(self.lengths[:-1], out=self.offsets[1:])
+        self.ids = np.frombuffer(b"".join(words), dtype=np.uint8).astype(np.int32)
+        self.counts = np.array(counts, dtype=np.int64)
+
+    @staticmethod
+    def _pairs(ids: np.ndarray, wids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # packed codes of the adjacent pairs of `ids` that lie within one word, and the word of each
+        same = wids[:-1] == wids[1:]
+        keys = (ids[:-1].astype(np.int64) << 32) | ids[1:]
+        return keys[same], wids[:-1][same]
+
+    def _count_pairs(self):
+        # every word is stored without a tail here, so ids is exactly the concatenation of the words
+        wids = np.repeat(np.arange(len(self.lengths)), self.lengths)
+        keys, key_wids = self._pairs(self.ids, wids)
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        freq = np.bincount(inverse, weights=self.counts[key_wids], minlength=len(uniq))
+        self.p_freq = collections.defaultdict(int, zip(uniq.tolist(), freq.astype(np.int64).tolist()))
+
+        # pair2word as in IntBPE: array('i') of word ids per pair, repeats dropped when the pair is merged
+        order = np.argsort(inverse, kind="stable")
+        splits = np.flatnonzero(np.diff(inverse[order])) + 1
+        self.pair2word = collections.defaultdict(functools.partial(array, "i"))
+        for key, group in zip(uniq.tolist(), np.split(key_wids[order].astype(np.int32), splits)):
+            self.pair2word[key].frombytes(group.tobytes())
+
+    def _gather(self, wids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # the ids of words `wids` back to back, and the index into wids of each position
+        lengths = self.lengths[wids]
+        local = np.repeat(np.arange(len(wids)), lengths)
+        starts = np.cumsum(lengths) - lengths
+        return self.ids[self.offsets[wids][local] + np.arange(len(local)) - starts[local]], local
+
+    def _apply_merge(self, key: int, new_id: int, delta: dict[int, int]):
+        wids = self.pair2word.pop(key, None)
+        if not wids:
+            return
+        if len(wids) <= VECTORIZE_MIN_WORDS:
+            self._apply_merge_words(key, new_id, delta, dict.fromkeys(wids))
+        else:
+            self._apply_merge_vectorized(key, new_id, delta, np.unique(np.frombuffer(wids, dtype=np.int32)))
+
+    def _apply_merge_words(self, key: int, new_id: int, delta: dict[int, int], wids):
+        # IntBPE's merge, word by word: cheaper than the numpy calls for a handful of words
+        a, b = unpack_pair(key)
+        pair2word, ids, offsets, lengths = self.pair2word, self.ids, self.offsets, self.lengths
+        for wid in wids:
+            start = offsets[wid]
+            merged = local_merge_ids(ids[start:start + lengths[wid]].tolist(), a, b, new_id,
+                                     int(self.counts[wid]), delta)
+            if merged is None:
+                continue
+            ids[start:start + len(merged)] = merged
+            lengths[wid] = len(merged)
+            for x, y in zip(merged[:-1], merged[1:]):
+                if x == new_id or y == new_id:
+                    listed = pair2word[(x << 32) | y]
+                    if not listed or listed[-1] != wid:
+                        listed.append(wid)
+
+    def _apply_merge_vectorized(self, key: int, new_id: int, delta: dict[int, int], wids: np.ndarray):
+        a, b = unpack_pair(key)
+        seg, local = self._gather(wids)
+        counts = self.counts[wids]
+
+        hit = (seg[:-1] == a) & (seg[1:] == b) & (local[:-1] == local[1:])
+        if a == b:
+            hit = non_overlapping(hit)
+        sites = np.flatnonzero(hit)
+        if not len(sites):
+            return
+        merged = seg.copy()
+        merged[sites] = new_id
+        keep = np.ones(len(seg), dtype=bool)
+        keep[sites + 1] = False
+        merged, merged_local = merged[keep], local[keep]
+
+        # scatter the words back, each to the start of its span, and shrink them
+        lengths = np.bincount(merged_local, minlength=len(wids))
+        starts = np.cumsum(lengths) - lengths
+        self.ids[self.offsets[wids][merged_local] + np.arange(len(merged)) - starts[merged_local]] = merged
+        self.lengths[wids] = lengths
+
+        # count delta: the pairs of these words after the merge minus before
+        old_keys, old_local = self._pairs(seg, local)
+        new_keys, new_local = self._pairs(merged, merged_local)
+        keys = np.concatenate((old_keys, new_keys))
+        weights = np.concatenate((-counts[old_local], counts[new_local]))
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        change = np.bincount(inverse, weights=weights, minlength=len(uniq)).astype(np.int64)
+        changed = change != 0
+        for k, d in zip(uniq[changed].tolist(), change[changed].tolist()):
+            delta[k] += d
+
+        # index the words under the pairs the new token forms
+        new_pairs = ((new_keys >> 32) == new_id) | ((new_keys & 0xFFFFFFFF) == new_id)
+        new_keys, new_wids = new_keys[new_pairs], wids[new_local[new_pairs]]
+        if not len(new_keys):
+            return
+        order = np.argsort(new_keys, kind="stable")
+        new_keys, new_wids = new_keys[order], new_wids[order]
+        splits = np.flatnonzero(np.diff(new_keys)) + 1
+        pair2word = self.pair2word
+        for k, group in zip(new_keys[np.concatenate(([0], splits))].tolist(),
+                            np.split(new_wids.astype(np.int32), splits)):
+            pair2word[k].frombytes(group.tobytes())
+
+    def state_dict(self) -> dict:
+        # IntBPE's format, so checkpoints load into either engine: the words packed without their tails
+        lengths = self.lengths
+        seg, _ = self._gather(np.arange(len(lengths)))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return {
+            "tokens": self.tokens,
+            "merges": self.merges,
+            "ids": array("i", seg.astype(np.int32).tobytes()),
+            "offsets": array("q", offsets.tobytes()),
+            "counts": array("q", self.counts.tobytes()),
+        }
+
+    @classmethod
+    def from_state_dict(cls, state: dict) -> "NumpyBPE":
+        self = cls.__new__(cls)
+        self.tokens = list(state["tokens"])
+        self.token_ids = {t: i for i, t in enumerate(self.tokens)}
+        self.merges = list(state["merges"])
+        offsets = np.frombuffer(state["offsets"], dtype=np.int64)
+        self.ids = np.frombuffer(state["ids"], dtype=np.int32).copy()
+        self.offsets = offsets[:-1].copy()
+        self.lengths = np.diff(offsets)
+        self.counts = np.frombuffer(state["counts"], dtype=np.int64).copy()
+        self._build_index()
+        return self
+
+
+def save_checkpoint(path, bpe: IntBPE, extra_state: dict | None = None):
+    state = {"bpe": bpe.state_dict(), **(extra_state or {})}
+    # write to a temp file and rename, so a run killed mid-write keeps the previous checkpoint
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path, engine_cls: type[IntBPE] = IntBPE) -> tuple[IntBPE, dict]:
+    # IntBPE and NumpyBPE share the state format, so either can continue the other's checkpoints
+    with open(path, "rb") as f:
+        state = pickle.load(f)
+    return engine_cls.from_state_dict(state.pop("bpe")), state
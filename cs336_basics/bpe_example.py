@@ -1,11 +1,22 @@
+import heapq
+
+import numpy as np
+
+from cs336_basics.bpe_engine import non_overlapping
 from cs336_basics.pretokenization_example import find_chunk_boundaries, HERE
 
 WS = {9, 10, 11, 12, 13, 32}  # \t \n \v \f \r ' '
 EOF = '<|endoftext|>'
 
 
-def toy_bpe(input_path: str, vocab_size: int, special_tokens: list[str]) -> tuple[
+def toy_bpe(input_path: str, vocab_size: int, special_tokens: list[str], engine: str = "list") -> tuple[
     dict[int, bytes], list[tuple[bytes, bytes]]]:
+    """
+    engine: "list" recounts and rewrites the whole ids list in Python every merge, "numpy" keeps it in an
+    ArrayBPE. Both make the same merges.
+    """
+    if engine not in ("list", "numpy"):
+        raise ValueError(f"unknown engine: {engine}")
     merges: dict[tuple[bytes, bytes], int] = {}
 
     vocab = init_vocab()
@@ -22,18 +33,25 @@ def toy_bpe(input_path: str, vocab_size: int, special_tokens: list[str]) -> tupl
             f.seek(start)
             tokens = pre_tokenize(f.read(end - start))
             ids.extend(list(tokens))
+            stream = ArrayBPE(ids) if engine == "numpy" else None
 
             for i in range(merge_cnt):
-                freq = get_freq(ids)
-                if not freq:
-                    break
-                _, pair = get_most_frequent_pair(freq)
                 new_id = base_vocab_size + i
-
-                ids = merge(ids, new_id, pair)
+                if stream is not None:
+                    pair = stream.merge_most_frequent(new_id)
+                    if pair is None:
+                        break
+                else:
+                    freq = get_freq(ids)
+                    if not freq:
+                        break
+                    _, pair = get_most_frequent_pair(freq)
+                    ids = merge(ids, new_id, pair)
                 merges[pair] = new_id
                 vocab[new_id] = vocab[pair[0]] + vocab[pair[1]]
                 print(f'merge {vocab[pair[0]]} and {vocab[pair[1]]} : {vocab[new_id]}')
+            if stream is not None:
+                ids = stream.ids.tolist()
 
     return vocab, list(tuple(merges.keys()))
 
@@ -75,6 +93,88 @@ def merge(ids, idx, pair):
     return updated_ids
 
 
+class ArrayBPE:
+    """
+    The ids stream of toy_bpe as a uint32 array, with pair counts kept up to date instead of recounted.
+
+    Pairs are packed as (a << 32) | b, so ordering codes orders pairs like get_most_frequent_pair does.
+    The first count is one np.bincount over a * 256 + b (the stream starts as raw bytes); after that each
+    merge recounts only the pairs next to its sites. The most frequent pair comes from a lazy heap: an
+    entry whose count is stale is dropped when popped.
+    """
+
+    def __init__(self, ids):
+        self.ids = np.asarray(ids, dtype=np.uint32)
+        self.ws = np.array(sorted(WS), dtype=np.uint32)
+        a, b = self.ids[:-1], self.ids[1:]
+        valid = self._valid(self.ids)
+        freq = np.bincount(a[valid].astype(np.int64) * 256 + b[valid], minlength=256 * 256)
+        codes = np.flatnonzero(freq)
+        self.freq: dict[int, int] = dict(zip(((codes >> 8 << 32) | (codes & 255)).tolist(), freq[codes].tolist()))
+        self.heap = [(-count, -code) for code, count in self.freq.items()]
+        heapq.heapify(self.heap)
+
+    def _valid(self, ids: np.ndarray) -> np.ndarray:
+        # pairs get_freq counts: neither side ASCII white space
+        not_ws = ~np.isin(ids, self.ws)
+        return not_ws[:-1] & not_ws[1:]
+
+    def _codes(self, ids: np.ndarray, starts: np.ndarray) -> np.ndarray:
+        # packed codes of the counted pairs starting at `starts`
+        starts = starts[(starts >= 0) & (starts < len(ids) - 1)]
+        starts = starts[self._valid(ids)[starts]] if len(starts) else starts
+        return (ids[starts].astype(np.int64) << 32) | ids[starts + 1]
+
+    def _pop(self) -> tuple[int, int] | None:
+        while self.heap:
+            neg_count, neg_code = heapq.heappop(self.heap)
+            if self.freq.get(-neg_code) == -neg_count:
+                return -neg_code >> 32, -neg_code & 0xFFFFFFFF
+        return None
+
+    def merge_most_frequent(self, new_id: int) -> tuple[int, int] | None:
+        """
+        Merge the most frequent pair into new_id, left to right without overlaps like merge(), and return
+        it; None when no pair is left.
+        """
+        pair = self._pop()
+        if pair is None:
+            return None
+        a, b = pair
+        ids = self.ids
+        hit = (ids[:-1] == a) & (ids[1:] == b)
+        if a == b:
+            hit = non_overlapping(hit)
+        sites = np.flatnonzero(hit)
+
+        merged = ids.copy()
+        merged[sites] = new_id
+        keep = np.ones(len(ids), dtype=bool)
+        keep[sites + 1] = False
+        merged = merged[keep]
+        # new_id's position in the merged stream: each earlier site removed one id
+        new_sites = sites - np.arange(len(sites))
+
+        # only pairs overlapping a site change: those starting at i - 1, i, i + 1 before, j - 1, j after
+        old = self._codes(ids, np.unique(np.concatenate((sites - 1, sites, sites + 1))))
+        new = self._codes(merged, np.unique(np.concatenate((new_sites - 1, new_sites))))
+        codes, inverse = np.unique(np.concatenate((old, new)), return_inverse=True)
+        change = np.bincount(inverse, weights=np.concatenate((-np.ones(len(old)), np.ones(len(new)))),
+                             minlength=len(codes)).astype(np.int64)
+        freq = self.freq
+        for code, d in zip(codes.tolist(), change.tolist()):
+            if not d:
+                continue
+            count = freq.get(code, 0) + d
+            if count:
+                freq[code] = count
+                heapq.heappush(self.heap, (-count, -code))
+            else:
+                del freq[code]
+        self.ids = merged
+        return a, b
+
+
 if __name__ == '__main__':
     v, m = toy_bpe(HERE / "corpus.txt", 256 + 1 + 6, special_tokens=[EOF])
     print(v)
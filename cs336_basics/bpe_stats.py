@@ -0,0 +1,215 @@
+import contextlib
+import cProfile
+import os
+import threading
+import tracemalloc
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+
+import psutil
+
+from cs336_basics.utils import now
+
+
+@contextlib.contextmanager
+def profiled(path):
+    """
+    Run the block under cProfile and dump the stats to `path` (a no-op when path is None).
+    Works inside pool workers too, since each process profiles its own block.
+    """
+    if path is None:
+        yield
+        return
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        prof.dump_stats(path)
+
+
+class RssSampler:
+    """
+    Background thread polling the RSS of this process and all of its children every `interval` seconds.
+    `peak_total` is the highest sum seen at once, `peak_by_pid` the highest RSS of each process.
+    Short-lived peaks between two polls are missed.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak_total = 0
+        self.peak_by_pid: dict[int, int] = {}
+        self._proc = psutil.Process(os.getpid())
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def sample(self):
+        total = 0
+        for proc in [self._proc, *self._proc.children(recursive=True)]:
+            try:
+                rss = proc.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            total += rss
+            self.peak_by_pid[proc.pid] = max(self.peak_by_pid.get(proc.pid, 0), rss)
+        self.peak_total = max(self.peak_total, total)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+@dataclass
+class TrainStats:
+    """
+    Per-phase timings of one train_bpe run. Pass an instance as train_bpe(stats=...) and it is filled in;
+    train_bpe also logs summary() at INFO level.
+
+    phases: seconds per phase, among "boundaries", "pre_tokenize", "reduce", "cache", "min_freq",
+    "pair_counts" and "merges".
+    pre_tokens: unique pre-tokens handed to the merge engine.
+    pruned_pre_tokens / pruned_occurrences: unique pre-tokens and occurrences dropped by min_freq.
+    sampled_docs / sampled_bytes out of corpus_docs / corpus_bytes: what a DocSample trained on, and
+    sample_coverage the estimated share of the corpus's pre-token occurrences the sample has seen (see
+    doc_sampling.estimate_coverage).
+    worker_busy / worker_idle: seconds each pre-tokenization worker (by pid) spent on slices / waiting.
+    merge_samples: (merges done, seconds since the merge loop started) every `sample_every` merges.
+    profile_dir: if set, a cProfile dump is written there for every pre-tokenization job
+    (pretokenize-<pid>-<job_id>.prof, job_id its index in the plan) and for the merge loop (merges.prof).
+
+    Memory, all in bytes:
+    rss_interval: if set, an RssSampler polls this process and its children every that many seconds
+    during each phase, filling phase_rss (peak parent + children RSS at once) and process_rss (peak RSS
+    per pid, parent included).
+    worker_peak_rss: ru_maxrss each pre-tokenization worker process reports for itself. Empty with the
+    thread backend, where it would only be the whole process's.
+    children_peak_rss: RUSAGE_CHILDREN once the pool is shut down: the largest child this process has ever
+    waited for, over its whole lifetime rather than this run, and blind to persistent pools, whose workers
+    have not exited. worker_peak_rss is the per-run figure.
+    trace_merges: if True, tracemalloc runs from initial pair counting to the end of the merge loop;
+    merge_traced_peak is the peak traced Python allocation and merge_traced_top the `trace_top` largest
+    allocation sites (file:line, bytes) right after the pair index is built.
+    """
+    profile_dir: str | None = None
+    sample_every: int = 500
+    rss_interval: float | None = None
+    trace_merges: bool = False
+    trace_top: int = 10
+    phases: dict[str, float] = field(default_factory=dict)
+    worker_busy: dict[int, float] = field(default_factory=dict)
+    worker_idle: dict[int, float] = field(default_factory=dict)
+    merge_samples: list[tuple[int, float]] = field(default_factory=list)
+    phase_rss: dict[str, int] = field(default_factory=dict)
+    process_rss: dict[int, int] = field(default_factory=dict)
+    worker_peak_rss: dict[int, int] = field(default_factory=dict)
+    children_peak_rss: int = -1
+    merge_traced_peak: int = 0
+    merge_traced_top: list[tuple[str, int]] = field(default_factory=list)
+    pre_tokens: int = 0
+    pruned_pre_tokens: int = 0
+    pruned_occurrences: int = 0
+    sampled_docs: int = 0
+    sampled_bytes: int = 0
+    corpus_docs: int = 0
+    corpus_bytes: int = 0
+    sample_coverage: float = 0.0
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = now()
+        sampler = RssSampler(self.rss_interval) if self.rss_interval else contextlib.nullcontext()
+        try:
+            with sampler:
+                yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + now() - start
+            if self.rss_interval:
+                self.phase_rss[name] = max(self.phase_rss.get(name, 0), sampler.peak_total)
+                for pid, rss in sampler.peak_by_pid.items():
+                    self.process_rss[pid] = max(self.process_rss.get(pid, 0), rss)
+
+    @contextlib.contextmanager
+    def traced(self):
+        """
+        Run the block under tracemalloc if trace_merges is set; call snapshot() inside it to record the
+        largest allocation sites.
+        """
+        if not self.trace_merges or tracemalloc.is_tracing():
+            yield
+            return
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            self.merge_traced_peak = max(self.merge_traced_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+    def snapshot(self):
+        if not self.trace_merges or not tracemalloc.is_tracing():
+            return
+        stats = tracemalloc.take_snapshot().statistics("lineno")
+        self.merge_traced_top = [(str(st.traceback), st.size) for st in stats[:self.trace_top]]
+
+    def profile_path(self, name: str) -> Path | None:
+        return None if self.profile_dir is None else Path(self.profile_dir) / f"{name}.prof"
+
+    def record_workers(self, busy: dict[int, float], elapsed: float, peak_rss: dict[int, int] | None = None):
+        for pid, t in busy.items():
+            self.worker_busy[pid] = self.worker_busy.get(pid, 0.0) + t
+            self.worker_idle[pid] = self.worker_idle.get(pid, 0.0) + elapsed - t
+        for pid, rss in (peak_rss or {}).items():
+            self.worker_peak_rss[pid] = max(self.worker_peak_rss.get(pid, 0), rss)
+
+    def merge_rates(self) -> list[tuple[int, float]]:
+        """
+        merges/sec between consecutive samples, keyed by the merge count at the end of each window.
+        """
+        rates = []
+        prev_n, prev_t = 0, 0.0
+        for n, t in self.merge_samples:
+            if t > prev_t:
+                rates.append((n, (n - prev_n) / (t - prev_t)))
+            prev_n, prev_t = n, t
+        return rates
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), "merge_rates": self.merge_rates()}
+
+    def summary(self) -> str:
+        mb = 1 << 20
+        lines = []
+        for name, t in self.phases.items():
+            rss = f"  peak RSS {self.phase_rss[name] / mb:8.1f} MB" if name in self.phase_rss else ""
+            lines.append(f"{name:<12} {t:8.3f}s{rss}")
+        for pid in sorted(self.worker_busy):
+            rss = f" peak RSS {self.worker_peak_rss[pid] / mb:.1f} MB" if pid in self.worker_peak_rss else ""
+            lines.append(f"worker {pid:<6} busy {self.worker_busy[pid]:.3f}s idle {self.worker_idle[pid]:.3f}s{rss}")
+        if self.pre_tokens:
+            lines.append(f"pre-tokens   {self.pre_tokens}")
+        if self.pruned_pre_tokens:
+            lines.append(f"min_freq dropped {self.pruned_pre_tokens} pre-tokens, {self.pruned_occurrences} occurrences")
+        if self.corpus_docs:
+            lines.append(f"sample       {self.sampled_docs}/{self.corpus_docs} documents, "
+                         f"{self.sampled_bytes / max(1, self.corpus_bytes):.1%} of bytes, "
+                         f"estimated coverage {self.sample_coverage:.3f}")
+        if self.children_peak_rss > 0:
+            lines.append(f"largest exited child peak RSS so far {self.children_peak_rss / mb:.1f} MB")
+        if self.merge_traced_peak:
+            lines.append(f"merge loop traced peak {self.merge_traced_peak / mb:.1f} MB")
+            lines.extend(f"  {site:<40} {size / mb:8.1f} MB" for site, size in self.merge_traced_top)
+        if self.merge_samples:
+            n, t = self.merge_samples[-1]
+            lines.append(f"merges       {n} in {t:.3f}s, {n / t if t else float('inf'):.0f} merges/s")
+        return "\n".join(lines)
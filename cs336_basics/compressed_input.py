@@ -0,0 +1,209 @@
+import bz2
+import functools
+import gzip
+import io
+import lzma
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import BinaryIO, Iterator, TextIO
+
+# Compressed corpora are read without an uncompressed copy on disk. Where the format marks independent
+# members, a file is split into jobs of whole members that workers decompress in parallel:
+#   .gz  BGZF (bgzip) blocks, whose headers carry the block size
+#   .xz  streams (concatenated .xz files) and, within a stream, LZMA2 blocks (xz -T / --block-size),
+#        both found from the stream index at the end of the file
+#   .bz2 streams (pbzip2, concatenated .bz2 files), found by their byte-aligned magic
+# Anything else (a plain gzip file, one bz2 stream) has a single member and is read by one streaming
+# reader whose output is fanned out to the pool (see pretokenization.iter_stream_jobs).
+# opener of each format, taking a path or a binary file object
+CONTAINERS = {".gz": gzip.open, ".xz": lzma.open, ".bz2": bz2.open}
+_READ_BYTES = 1 << 20
+
+
+def is_compressed(path) -> bool:
+    return Path(path).suffix in CONTAINERS
+
+
+def open_text(path) -> TextIO:
+    # text reader for plain or compressed files, e.g. to feed Tokenizer.encode_iterable. newline="" keeps
+    # \r\n and \r as they are, as train_bpe reads them
+    return CONTAINERS.get(Path(path).suffix, open)(path, "rt", encoding="utf-8", newline="")
+
+
+class _RangeReader(io.RawIOBase):
+    # the bytes [start, end) of a file, for the container readers
+    def __init__(self, f: BinaryIO, start: int, end: int):
+        self.f = f
+        self.pos = start
+        self.end = end
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self.end - self.pos)
+        if n <= 0:
+            return 0
+        self.f.seek(self.pos)
+        data = self.f.read(n)
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+
+# A member: compressed byte range [start, end) and, for an xz block, the raw LZMA2 filter chain and the
+# size of the block header to skip. Other members are whole streams the container reader handles.
+Member = tuple[int, int, list | None, int]
+
+
+def _bgzf_members(mm) -> list[Member] | None:
+    members = []
+    pos = 0
+    while pos < len(mm):
+        # ID1 ID2 CM=8 FLG=FEXTRA, MTIME, XFL, OS, XLEN, then the "BC" subfield holding BSIZE
+        if mm[pos:pos + 4] != b"\x1f\x8b\x08\x04" or mm[pos + 12:pos + 14] != b"BC":
+            return None
+        (bsize,) = struct.unpack_from("<H", mm, pos + 16)
+        members.append((pos, pos + bsize + 1, None, 0))
+        pos += bsize + 1
+    return members
+
+
+def _read_varint(buf, pos: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        value |= (byte & 0x7F) << shift
+        pos += 1
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _lzma2_block_filters(mm, pos: int) -> tuple[list, int] | None:
+    # the filter chain and header size of the xz block at pos, if it is a plain LZMA2 block
+    header_size = (mm[pos] + 1) * 4
+    flags = mm[pos + 1]
+    p = pos + 2
+    if flags & 0x03:  # more than one filter (BCJ, delta...)
+        return None
+    if flags & 0x40:
+        _, p = _read_varint(mm, p)
+    if flags & 0x80:
+        _, p = _read_varint(mm, p)
+    filter_id, p = _read_varint(mm, p)
+    props_size, p = _read_varint(mm, p)
+    if filter_id != lzma.FILTER_LZMA2 or props_size != 1:
+        return None
+    bits = mm[p] & 0x3F
+    dict_size = 0xFFFFFFFF if bits == 40 else (2 | (bits & 1)) << (bits // 2 + 11)
+    return [{"id": lzma.FILTER_LZMA2, "dict_size": dict_size}], header_size
+
+
+def _xz_members(mm) -> list[Member] | None:
+    streams = []
+    end = len(mm)
+    while end > 0:
+        # stream padding: zero bytes in multiples of 4 between streams
+        while end >= 4 and mm[end - 4:end] == b"\0\0\0\0":
+            end -= 4
+        if end == 0:
+            break
+        footer = end - 12
+        if mm[footer + 10:end] != b"YZ":
+            return None
+        backward_size = (struct.unpack_from("<I", mm, footer + 4)[0] + 1) * 4
+        index = footer - backward_size
+        if mm[index] != 0:
+            return None
+        num_records, p = _read_varint(mm, index + 1)
+        unpadded = []
+        for _ in range(num_records):
+            size, p = _read_varint(mm, p)
+            _, p = _read_varint(mm, p)
+            unpadded.append(size)
+        start = index - sum(-(-u // 4) * 4 for u in unpadded) - 12
+        streams.append((start, end, unpadded))
+        end = start
+
+    members = []
+    for start, end, unpadded in reversed(streams):
+        blocks = []
+        pos = start + 12
+        for u in unpadded:
+            parsed = _lzma2_block_filters(mm, pos)
+            if parsed is None:
+                blocks = None
+                break
+            blocks.append((pos, pos + -(-u // 4) * 4, *parsed))
+            pos += -(-u // 4) * 4
+        # a stream whose blocks cannot be decoded on their own is one member
+        members += blocks if blocks and len(blocks) > 1 else [(start, end, None, 0)]
+    return members
+
+
+def _bz2_members(mm) -> list[Member]:
+    # stream header "BZh" + level digit + the block magic pi; 80 bits, so a false match is not a concern
+    starts = []
+    pos = 0
+    while (pos := mm.find(b"BZh", pos)) != -1:
+        if mm[pos + 3:pos + 4].isdigit() and mm[pos + 4:pos + 10] == b"\x31\x41\x59\x26\x53\x59":
+            starts.append(pos)
+        pos += 3
+    if not starts or starts[0] != 0:
+        return [(0, len(mm), None, 0)]
+    return [(s, e, None, 0) for s, e in zip(starts, starts[1:] + [len(mm)])]
+
+
+def compressed_members(path) -> list[Member]:
+    """
+    The independently decodable members of a compressed file, in order; a single member when the
+    format does not mark any.
+    """
+    st = os.stat(path)
+    return _members(str(path), st.st_size, st.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=64)
+def _members(path: str, size: int, mtime_ns: int) -> list[Member]:
+    # cached per file version: plan_jobs and every job of the file ask for the same list
+    if size == 0:
+        return []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        suffix = Path(path).suffix
+        parse = {".gz": _bgzf_members, ".xz": _xz_members, ".bz2": _bz2_members}[suffix]
+        try:
+            members = parse(mm)
+        except (IndexError, struct.error):
+            # truncated or not what the suffix says: leave it to the container reader to complain
+            members = None
+    return members or [(0, size, None, 0)]
+
+
+def decode_members(path, members: list[Member]) -> Iterator[bytes]:
+    # decompressed bytes of consecutive members of `path`, in pieces of at most _READ_BYTES
+    with open(path, "rb") as f:
+        for start, end, filters, header_size in members:
+            if filters is not None:
+                decoder = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=filters)
+                f.seek(start + header_size)
+                data = f.read(end - start - header_size)
+                # the block's padding and check follow the LZMA2 data and are left unused
+                while not decoder.eof and (data or not decoder.needs_input):
+                    yield decoder.decompress(data, _READ_BYTES)
+                    data = b""
+                continue
+            # a whole stream, on its own: the readers stop at the zero padding xz allows between streams
+            raw = io.BufferedReader(_RangeReader(f, start, end))
+            with CONTAINERS[Path(path).suffix](raw, "rb") as reader:
+                while chunk := reader.read(_READ_BYTES):
+                    yield chunk
+
+
+def decode_stream(path, read_bytes: int = _READ_BYTES) -> Iterator[bytes]:
+    # the whole decompressed file, in pieces of at most read_bytes
+    with CONTAINERS[Path(path).suffix](path, "rb") as reader:
+        while chunk := reader.read(read_bytes):
+            yield chunk
@@ -0,0 +1,160 @@
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import random
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
+
+from cs336_basics.compressed_input import is_compressed
+from cs336_basics.pretokenization import Job
+
+# Training on a sample of the documents. A document-boundary index (the offset every document starts at)
+# is built once per file with a plain byte search for the delimiter, no decoding or pre-tokenization,
+# and cached next to the pre-token counts. Sampling then only reads the byte ranges of the documents
+# picked, so its cost scales with the sample.
+INDEX_SUFFIX = ".docs"
+
+
+@dataclass
+class DocSample:
+    """
+    Which documents to train on, the same ones on every run over the same files.
+
+    every: every `every`-th document, starting at document seed % every.
+    fraction: a uniformly random `fraction` of the documents, drawn with random.Random(seed).
+    delimiter: the special token separating documents. Each document starts at its delimiter (the first
+    at the start of its file), as in find_chunk_boundaries, and every file ends one.
+    """
+    every: int | None = None
+    fraction: float | None = None
+    seed: int = 0
+    delimiter: str = "<|endoftext|>"
+
+    def __post_init__(self):
+        if (self.every is None) == (self.fraction is None):
+            raise ValueError("set exactly one of every and fraction")
+        if self.every is not None and self.every < 1:
+            raise ValueError("every must be at least 1")
+        if self.fraction is not None and not 0 < self.fraction <= 1:
+            raise ValueError("fraction must be in (0, 1]")
+
+    def pick(self, num_docs: int) -> list[int]:
+        if self.every is not None:
+            return list(range(self.seed % self.every, num_docs, self.every))
+        k = min(num_docs, max(1, round(self.fraction * num_docs)))
+        return sorted(random.Random(self.seed).sample(range(num_docs), k))
+
+
+def build_doc_index(path, delimiter: bytes) -> array:
+    # start offset of every document of `path`: 0 and each occurrence of the delimiter
+    starts = array("q")
+    if os.path.getsize(path) == 0:
+        return starts
+    starts.append(0)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = mm.find(delimiter, 1)
+        while pos != -1:
+            starts.append(pos)
+            pos = mm.find(delimiter, pos + len(delimiter))
+    return starts
+
+
+def load_doc_index(path, delimiter: bytes, cache_dir=None) -> array:
+    """
+    build_doc_index, kept in `cache_dir` if given. Keyed by the file's path, size and mtime and the
+    delimiter: unlike the pre-token cache this does not hash the contents, which would read the file.
+    """
+    if cache_dir is None:
+        return build_doc_index(path, delimiter)
+    st = os.stat(path)
+    key = {"path": str(Path(path).resolve()), "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+           "delimiter": delimiter.hex()}
+    digest = hashlib.blake2b(json.dumps(key, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+    index_path = Path(cache_dir) / f"{digest}{INDEX_SUFFIX}"
+    starts = array("q")
+    if index_path.exists():
+        starts.frombytes(index_path.read_bytes())
+        return starts
+    starts = build_doc_index(path, delimiter)
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    tmp = Path(f"{index_path}.tmp{os.getpid()}")
+    tmp.write_bytes(starts.tobytes())
+    os.replace(tmp, index_path)
+    return starts
+
+
+def sample_jobs(paths: list[Path], sample: DocSample, num_jobs: int, max_job_bytes: int | None = None,
+                cache_dir=None) -> tuple[list[Job], dict]:
+    """
+    The jobs pre-tokenizing just the documents `sample` picks across `paths`: about num_jobs of them, or
+    more if that makes them larger than max_job_bytes, with consecutive picked documents merged into one
+    slice. Also returns what was picked: documents and bytes, sampled and in total.
+    """
+    delimiter = sample.delimiter.encode("utf-8")
+    indexes, sizes = [], []
+    for path in paths:
+        if is_compressed(path):
+            raise ValueError(f"document sampling needs seekable files, {path} is compressed")
+        indexes.append(load_doc_index(path, delimiter, cache_dir))
+        sizes.append(os.path.getsize(path))
+    first_doc = [0]
+    for starts in indexes:
+        first_doc.append(first_doc[-1] + len(starts))
+
+    picked = sample.pick(first_doc[-1])
+    slices = []
+    for doc in picked:
+        i = bisect.bisect_right(first_doc, doc) - 1
+        starts, local = indexes[i], doc - first_doc[i]
+        start = starts[local]
+        end = starts[local + 1] if local + 1 < len(starts) else sizes[i]
+        if slices and slices[-1][0] == i and slices[-1][2] == start:
+            slices[-1][2] = end
+        else:
+            slices.append([i, start, end])
+
+    sampled_bytes = sum(end - start for _, start, end in slices)
+    job_bytes = max(1, -(-sampled_bytes // num_jobs))
+    if max_job_bytes is not None:
+        job_bytes = min(job_bytes, max_job_bytes)
+    jobs, job, size = [], [], 0
+    for i, start, end in slices:
+        # long runs of picked documents are cut at document starts into jobs of about job_bytes
+        starts = indexes[i]
+        while end - start > job_bytes - size:
+            cut_doc = bisect.bisect_right(starts, start + job_bytes - size) - 1
+            cut = starts[cut_doc] if cut_doc >= 0 else start
+            if cut <= start:
+                break
+            job.append((str(paths[i]), start, cut))
+            jobs.append(job)
+            job, size, start = [], 0, cut
+        job.append((str(paths[i]), start, end))
+        size += end - start
+        if size >= job_bytes:
+            jobs.append(job)
+            job, size = [], 0
+    if job:
+        jobs.append(job)
+    info = {
+        "sampled_docs": len(picked),
+        "total_docs": first_doc[-1],
+        "sampled_bytes": sampled_bytes,
+        "total_bytes": sum(sizes),
+    }
+    return jobs, info
+
+
+def estimate_coverage(counts) -> float:
+    """
+    Good-Turing estimate of the share of the corpus's pre-token occurrences whose pre-token also occurs
+    in the sample counted in `counts`: 1 - (pre-tokens seen once) / (occurrences).
+    """
+    total = singletons = 0
+    for count in counts.values():
+        total += count
+        singletons += count == 1
+    return 1.0 - singletons / total if total else 0.0
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+from array import array
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from cs336_basics.pretokenization import PackedCounts, pack_counts, resolve_inputs
+
+# File layout, native byte order like the arrays in pretokenization.pack_counts:
+#   magic (8 bytes) | n (int64) | offsets (n + 1 int64) | counts (n int64) | blob
+# i.e. a PackedCounts with a header in front.
+MAGIC = b"BPECNT01"
+_HEADER = struct.Struct("=8sq")
+CACHE_SUFFIX = ".counts"
+
+
+def file_digest(path, block_size: int = 1 << 20) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _file_key(path) -> dict:
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "content": file_digest(path)}
+
+
+def corpus_fingerprint(input_path, special_tokens, pattern: str) -> str:
+    """
+    Cache key for the pre-token counts of `input_path` (anything resolve_inputs takes): each file's size,
+    mtime and content hash in order, the pre-tokenization regex and the special-token set. Any change to
+    one of them misses the cache.
+    """
+    key = {"files": [_file_key(p) for p in resolve_inputs(input_path)]}
+    key["pattern"] = pattern
+    key["special_tokens"] = sorted(special_tokens)
+    return hashlib.blake2b(json.dumps(key, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def cache_path(cache_dir, fingerprint: str) -> Path:
+    return Path(cache_dir) / f"{fingerprint}{CACHE_SUFFIX}"
+
+
+def write_packed(path, packed: PackedCounts):
+    blob, offsets, counts = packed
+    n = len(counts) // 8
+    # write to a temp file and rename, so an interrupted run never leaves a truncated cache behind
+    tmp = Path(f"{path}.tmp{os.getpid()}")
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, n))
+        f.write(offsets)
+        f.write(counts)
+        f.write(blob)
+    os.replace(tmp, path)
+
+
+def write_counts_stream(path, items: Iterable[tuple[bytes, int]]) -> int:
+    """
+    write_packed for counts that do not fit in memory as a dict: the pre-tokens go straight to a side
+    file and only the offsets and counts (16 bytes per pre-token) are held until the end. Returns n.
+    """
+    offsets = array("q", [0])
+    counts = array("q")
+    tmp = Path(f"{path}.tmp{os.getpid()}")
+    blob_tmp = Path(f"{path}.blob{os.getpid()}")
+    with open(blob_tmp, "wb") as blob:
+        total = 0
+        for word, count in items:
+            blob.write(word)
+            total += len(word)
+            offsets.append(total)
+            counts.append(count)
+    with open(tmp, "wb") as f, open(blob_tmp, "rb") as blob:
+        f.write(_HEADER.pack(MAGIC, len(counts)))
+        offsets.tofile(f)
+        counts.tofile(f)
+        shutil.copyfileobj(blob, f)
+    os.remove(blob_tmp)
+    os.replace(tmp, path)
+    return len(counts)
+
+
+def save_counts(path, counts: dict[bytes, int]):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    write_packed(path, pack_counts(counts))
+
+
+def count_entries(path) -> int:
+    with open(path, "rb") as f:
+        magic, n = _HEADER.unpack(f.read(_HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a pre-token count file")
+    return n
+
+
+def iter_counts(path, batch: int = 1 << 16) -> Iterator[tuple[bytes, int]]:
+    """
+    Stream (pre-token, count) from a count file in file order, reading the offsets and counts `batch`
+    entries at a time, so memory stays flat however large the file is.
+    """
+    n = count_entries(path)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        offsets_start = _HEADER.size
+        counts_start = offsets_start + 8 * (n + 1)
+        blob_start = counts_start + 8 * n
+        for lo in range(0, n, batch):
+            hi = min(n, lo + batch)
+            offsets = array("q")
+            offsets.frombytes(mm[offsets_start + 8 * lo:offsets_start + 8 * (hi + 1)])
+            counts = array("q")
+            counts.frombytes(mm[counts_start + 8 * lo:counts_start + 8 * hi])
+            words = [mm[blob_start + i:blob_start + j] for i, j in zip(offsets, offsets[1:])]
+            yield from zip(words, counts)
+
+
+def load_counts(path) -> dict[bytes, int]:
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, n = _HEADER.unpack_from(mm)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a pre-token count file")
+        offsets_start = _HEADER.size
+        counts_start = offsets_start + 8 * (n + 1)
+        blob_start = counts_start + 8 * n
+        offsets = array("q")
+        offsets.frombytes(mm[offsets_start:counts_start])
+        # only the pre-tokens are copied out of the mapping, the blob is never read as a whole
+        words = (mm[blob_start + i:blob_start + j] for i, j in zip(offsets, offsets[1:]))
+        counts = array("q")
+        counts.frombytes(mm[counts_start:blob_start])
+        return dict(zip(words, counts))
+
@@ -0,0 +1,111 @@
+import heapq
+import itertools
+import os
+import tempfile
+import zlib
+from pathlib import Path
+from typing import Iterator
+
+from cs336_basics.pretoken_cache import CACHE_SUFFIX, count_entries, iter_counts, write_counts_stream
+
+# Out-of-core pre-token counting. Each worker spills its counts whenever they outgrow its budget, as
+# one sorted run file per partition (crc32 of the pre-token mod NUM_PARTITIONS, the same in every
+# process). Each partition's runs are then k-way merged into one sorted file, partitions in parallel.
+# No step ever holds more than one worker's budget of counts, plus the merge's 16 bytes per pre-token
+# of offsets and counts for one partition.
+NUM_PARTITIONS = 16
+DEFAULT_SPILL_MEMORY = 256 << 20
+# rough size of one entry of the str Counter a worker fills: the str, its hash slot and the int
+_BYTES_PER_ENTRY = 160
+
+
+def spill_entries_for(spill_memory: int) -> int:
+    return max(1, spill_memory // _BYTES_PER_ENTRY)
+
+
+def partition_of(word: bytes, num_partitions: int = NUM_PARTITIONS) -> int:
+    # not hash(): bytes hashes are salted per process
+    return zlib.crc32(word) % num_partitions
+
+
+def partition_dir(spill_dir, part: int) -> Path:
+    return Path(spill_dir) / f"part-{part:03d}"
+
+
+def write_runs(spill_dir, counts: dict[bytes, int], tag: str, num_partitions: int = NUM_PARTITIONS):
+    """
+    Write `counts` as one sorted run per non-empty partition, named run-<tag> in each partition dir.
+    """
+    parts: list[list[bytes]] = [[] for _ in range(num_partitions)]
+    for word in counts:
+        parts[partition_of(word, num_partitions)].append(word)
+    for part, words in enumerate(parts):
+        if not words:
+            continue
+        words.sort()
+        out = partition_dir(spill_dir, part)
+        out.mkdir(parents=True, exist_ok=True)
+        write_counts_stream(out / f"run-{tag}{CACHE_SUFFIX}", ((w, counts[w]) for w in words))
+
+
+def merge_sorted(iterators) -> Iterator[tuple[bytes, int]]:
+    # k-way merge of sorted (pre-token, count) streams, summing the counts of equal pre-tokens
+    merged = heapq.merge(*iterators, key=lambda item: item[0])
+    for word, group in itertools.groupby(merged, key=lambda item: item[0]):
+        yield word, sum(count for _, count in group)
+
+
+def merge_partition(spill_dir, part: int) -> Path | None:
+    """
+    Merge every run of partition `part` into one sorted file and delete the runs.
+    """
+    runs = sorted(partition_dir(spill_dir, part).glob(f"run-*{CACHE_SUFFIX}"))
+    if not runs:
+        return None
+    out = Path(spill_dir) / f"part-{part:03d}{CACHE_SUFFIX}"
+    write_counts_stream(out, merge_sorted(iter_counts(run) for run in runs))
+    for run in runs:
+        os.remove(run)
+    return out
+
+
+class SpilledCounts:
+    """
+    Read-only pre-token counts kept on disk, as sorted count files with disjoint pre-tokens (the merged
+    partitions, or a single cache file). Supports what the merge engines need: len(), iteration and
+    items(), each streaming the files. Owns `tmp_dir`, if given, which close() (or leaving a with block)
+    removes.
+    """
+
+    def __init__(self, paths: list[Path], tmp_dir: tempfile.TemporaryDirectory | None = None):
+        self.paths = paths
+        self._tmp_dir = tmp_dir
+
+    def __len__(self) -> int:
+        return sum(count_entries(p) for p in self.paths)
+
+    def items(self) -> Iterator[tuple[bytes, int]]:
+        for path in self.paths:
+            yield from iter_counts(path)
+
+    def __iter__(self) -> Iterator[bytes]:
+        return (word for word, _ in self.items())
+
+    def values(self) -> Iterator[int]:
+        return (count for _, count in self.items())
+
+    def save(self, path):
+        # partitions hold disjoint pre-tokens, so merging them is a sorted concatenation
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        write_counts_stream(path, merge_sorted(iter_counts(p) for p in self.paths))
+
+    def close(self):
+        if self._tmp_dir is not None:
+            self._tmp_dir.cleanup()
+            self._tmp_dir = None
+
+    def __enter__(self) -> "SpilledCounts":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,462 @@
+import glob
+import itertools
+import mmap
+import os
+import re as ascii_re
+import threading
+from array import array
+from pathlib import Path
+from typing import BinaryIO, Iterator
+
+import regex as re
+
+from cs336_basics.compressed_input import compressed_members, decode_members, decode_stream, is_compressed
+
+PAT = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+_PAT_RE = re.compile(PAT)
+# PAT restricted to ASCII text: \p{L} is [A-Za-z], \p{N} is [0-9] and \s is [\t\n\x0b\x0c\r ] there. Plain
+# character classes in the stdlib re engine run about twice as fast as the Unicode property lookups
+_ASCII_PAT_RE = ascii_re.compile(
+    r"""'(?:[sdmt]|ll|ve|re)| ?[A-Za-z]+| ?[0-9]+| ?[^\t\n\x0b\x0c\r A-Za-z0-9]+"""
+    r"""|[\t\n\x0b\x0c\r ]+(?![^\t\n\x0b\x0c\r ])|[\t\n\x0b\x0c\r ]+"""
+)
+_NON_ASCII = re.compile(r"[^\x00-\x7f]+")
+# str versions of _SAFE_SPLIT below: a PAT boundary around which each side pre-tokenizes the same
+_STR_SPLIT = re.compile(r"[\x21-\x7e](?=[\t\n\x0b\x0c\r ])")
+_STR_SPLIT_REV = re.compile(r"(?r)[\x21-\x7e](?=[\t\n\x0b\x0c\r ])")
+_DENSE_WINDOW = 256
+
+# Per-worker memory budget for pre-tokenization. A worker holds one raw block, its decoded str and the
+# special-token split of it at once, so blocks are a quarter of the budget. The pre-token Counter is
+# not included: it grows with the number of unique pre-tokens, not with the slice size.
+DEFAULT_WORKER_MEMORY = 1 << 30
+_BUDGET_PER_BLOCK_BYTE = 4
+
+# A printable non-space ASCII byte followed by an ASCII whitespace byte. No PAT match contains a
+# non-whitespace char followed by a whitespace char, so every such position is a pre-token boundary
+# and the text on either side pre-tokenizes the same as the whole. (?r) searches from the end.
+_SAFE_SPLIT = re.compile(rb"(?r)[\x21-\x7e](?=[\t\n\x0b\x0c\r ])")
+# forward versions for chunk boundaries, preferring a line break
+_NEWLINE_SPLIT = re.compile(rb"[\x21-\x7e](?=\n)")
+_SPACE_SPLIT = re.compile(rb"[\x21-\x7e](?=[\t\n\x0b\x0c\r ])")
+_BOUNDARY_WINDOW = 1 << 20
+
+
+_THREAD_STATE = threading.local()
+
+
+def use_concurrent_matching(enabled: bool = True):
+    """
+    Make pre_token_strings in the calling thread match with regex's concurrent=True, which releases the
+    GIL, instead of the ASCII fast path (stdlib re holds it). For pool threads; see worker_pool.
+    """
+    _THREAD_STATE.concurrent = enabled
+
+
+def is_concurrent_matching() -> bool:
+    return getattr(_THREAD_STATE, "concurrent", False)
+
+
+def pre_token_strings(chunk: str) -> list[str]:
+    """
+    The PAT matches of `chunk` (text without special tokens), in order. ASCII text is scanned with
+    _ASCII_PAT_RE; only the stretch around each run of non-ASCII chars, widened to the nearest safe
+    boundary on either side, goes through the full PAT. Where non-ASCII runs are close together (e.g.
+    German), the PAT stretch is widened by _DENSE_WINDOW chars so it is not entered and left every word.
+    """
+    if is_concurrent_matching():
+        return _PAT_RE.findall(chunk, concurrent=True)
+    if chunk.isascii():
+        return _ASCII_PAT_RE.findall(chunk)
+    tokens = []
+    pos = 0
+    for m in _NON_ASCII.finditer(chunk):
+        if m.start() < pos:
+            continue
+        lo = _STR_SPLIT_REV.search(chunk, pos, m.start())
+        lo = pos if lo is None else lo.end()
+        ahead = _DENSE_WINDOW if pos and lo - pos < _DENSE_WINDOW else 0
+        hi = _STR_SPLIT.search(chunk, m.end() + ahead)
+        hi = len(chunk) if hi is None else hi.end()
+        tokens += _ASCII_PAT_RE.findall(chunk, pos, lo)
+        tokens += _PAT_RE.findall(chunk, lo, hi)
+        pos = hi
+    tokens += _ASCII_PAT_RE.findall(chunk, pos)
+    return tokens
+
+
+def block_bytes_for(worker_memory: int) -> int:
+    return max(1, worker_memory // _BUDGET_PER_BLOCK_BYTE)
+
+
+def _inside_special(buf: bytes, pos: int, special_bytes: list[bytes]) -> bool:
+    # True if an occurrence of any special token starts before `pos` and ends after it
+    for tok in special_bytes:
+        i = buf.find(tok, max(0, pos - len(tok) + 1), pos + len(tok) - 1)
+        if i != -1 and i < pos:
+            return True
+    return False
+
+
+def find_safe_split(buf: bytes, special_bytes: list[bytes]) -> int:
+    """
+    Return the last position in `buf` where the bytes can be cut without changing pre-tokenization,
+    or -1 if there is none. Prefers the start of a special token, then falls back to a whitespace
+    boundary (see _SAFE_SPLIT), skipping positions that fall inside a special token.
+    """
+    # stay far enough from the end that a special token spanning the cut would be complete in `buf`
+    limit = len(buf) - max((len(tok) for tok in special_bytes), default=1) + 1
+
+    best = -1
+    for tok in special_bytes:
+        end = limit + len(tok)
+        while True:
+            i = buf.rfind(tok, 0, end)
+            if i <= best:
+                break
+            if not _inside_special(buf, i, special_bytes):
+                best = i
+                break
+            end = i + len(tok) - 1
+    if best > 0:
+        return best
+
+    end = limit
+    while end > 0:
+        m = _SAFE_SPLIT.search(buf, 0, end + 1)
+        if m is None:
+            break
+        if not _inside_special(buf, m.end(), special_bytes):
+            return m.end()
+        end = m.end() - 1
+    return -1
+
+
+def first_safe_split(buf: bytes, special_bytes: list[bytes], start: int) -> int:
+    """
+    Return the first position >= `start` in `buf` where the bytes can be cut without changing
+    pre-tokenization (a special token start or a _SAFE_SPLIT boundary, not inside a special token) and
+    that has a special token's length of bytes after it, or -1. Unlike find_safe_split the answer does not
+    depend on how far `buf` extends past it, so readers of overlapping pieces of a stream agree on it.
+    """
+    max_len = max((len(tok) for tok in special_bytes), default=1)
+    limit = len(buf) - max_len
+    best = -1
+    for tok in special_bytes:
+        i = buf.find(tok, start, limit + len(tok))
+        while i != -1 and _inside_special(buf, i, special_bytes):
+            i = buf.find(tok, i + 1, limit + len(tok))
+        if i != -1 and (best == -1 or i < best):
+            best = i
+    for m in _SPACE_SPLIT.finditer(buf, max(0, start - 1), limit + 1 if best == -1 else best):
+        if not _inside_special(buf, m.end(), special_bytes):
+            return m.end()
+    return best
+
+
+def _next_safe_split(mm, pos: int, end: int, special_bytes: list[bytes]) -> int:
+    """
+    First position in [pos, end) of `mm` where the file can be split without changing pre-tokenization:
+    the start of any special token, else a line break, else any whitespace boundary; -1 if there is none.
+    """
+    max_len = max((len(tok) for tok in special_bytes), default=1)
+
+    def context(i):
+        # the bytes around i, enough to see a special token spanning it
+        lo = max(0, i - max_len + 1)
+        return mm[lo:i + max_len], i - lo
+
+    best = end
+    for tok in special_bytes:
+        i = mm.find(tok, pos, best)
+        while i != -1 and _inside_special(*context(i), special_bytes):
+            i = mm.find(tok, i + 1, best)
+        if i != -1:
+            best = i
+    if best < end:
+        return best
+
+    for pattern in (_NEWLINE_SPLIT, _SPACE_SPLIT):
+        # scan window by window so a file without any special token is never read whole
+        for lo in range(pos, end, _BOUNDARY_WINDOW):
+            hi = min(end, lo + _BOUNDARY_WINDOW)
+            buf = mm[lo:hi + max_len]
+            for m in pattern.finditer(buf, 0, hi - lo + 1):
+                i = lo + m.end()
+                if i < end and not _inside_special(*context(i), special_bytes):
+                    return i
+    return -1
+
+
+def find_chunk_boundaries(file: BinaryIO, desired_num_chunks: int, special_bytes: list[bytes]) -> list[int]:
+    """
+    Split the file into about `desired_num_chunks` byte ranges that can be pre-tokenized independently.
+
+    Unlike pretokenization_example.find_chunk_boundaries this works on an mmap of the file, accepts any of
+    the special tokens and falls back to a line break or whitespace boundary (see _SAFE_SPLIT), so a
+    corpus without special tokens still splits evenly. May return fewer chunks if boundaries collide.
+    """
+    file_size = os.fstat(file.fileno()).st_size
+    if file_size == 0:
+        return [0]
+    chunk_size = max(1, file_size // desired_num_chunks)
+    boundaries = [0]
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for bi in range(1, desired_num_chunks):
+            guess = max(bi * chunk_size, boundaries[-1] + 1)
+            if guess >= file_size:
+                break
+            # search up to the next guess; a boundary past it would only collide with the next one.
+            # Without any safe split in there, this chunk is merged into the next
+            split = _next_safe_split(mm, guess, min(file_size, guess + chunk_size), special_bytes)
+            if split > 0:
+                boundaries.append(split)
+    boundaries.append(file_size)
+    return sorted(set(boundaries))
+
+
+def resolve_inputs(input_path) -> list[Path]:
+    """
+    The files a train_bpe input stands for, in a fixed order: a file is itself, a directory every file
+    below it (sorted, hidden files skipped), a string with glob characters its matches (sorted, ** allowed)
+    and a list or tuple the concatenation of its items.
+    """
+    if isinstance(input_path, (list, tuple)):
+        return [p for item in input_path for p in resolve_inputs(item)]
+    path = Path(input_path)
+    if path.is_dir():
+        return sorted(p for p in path.rglob("*")
+                      if p.is_file() and not any(part.startswith(".") for part in p.relative_to(path).parts))
+    if not path.exists() and glob.has_magic(str(input_path)):
+        matches = sorted(Path(p) for p in glob.glob(str(input_path), recursive=True))
+        if not matches:
+            raise FileNotFoundError(f"no file matches {input_path}")
+        return [p for m in matches for p in resolve_inputs(m)]
+    return [path]
+
+
+# A pre-tokenization job: slices handled by one worker call, one result per job. A slice is a byte range
+# (path, start, end) of a file, in compressed bytes for a compressed one (see iter_member_blocks), or
+# bytes already read (see iter_stream_jobs)
+Job = list[tuple[str, int, int] | bytes]
+
+
+def plan_jobs(paths: list[Path], job_bytes: int, special_bytes: list[bytes]) -> list[Job]:
+    """
+    Cut the files into jobs of about `job_bytes` each: a file larger than that is split at safe boundaries
+    (find_chunk_boundaries), and consecutive smaller files are batched into one job until it reaches
+    job_bytes, so hundreds of small shards do not each cost a task and a result. Compressed files are
+    sized by their compressed bytes and split between runs of whole members (see compressed_members);
+    one without members gets a job of its own.
+    """
+    jobs = []
+    batch, batch_bytes = [], 0
+    for path in paths:
+        size = os.path.getsize(path)
+        if size == 0:
+            continue
+        if size <= job_bytes:
+            batch.append((str(path), 0, size))
+            batch_bytes += size
+            if batch_bytes >= job_bytes:
+                jobs.append(batch)
+                batch, batch_bytes = [], 0
+            continue
+        if is_compressed(path):
+            boundaries = [0]
+            for start, *_ in compressed_members(path)[1:]:
+                if start - boundaries[-1] >= job_bytes:
+                    boundaries.append(start)
+            boundaries.append(size)
+        else:
+            with open(path, "rb") as f:
+                boundaries = find_chunk_boundaries(f, -(-size // job_bytes), special_bytes)
+        jobs += [[(str(path), start, end)] for start, end in zip(boundaries[:-1], boundaries[1:])]
+    if batch:
+        jobs.append(batch)
+    return jobs
+
+
+def iter_member_blocks(path, start: int, end: int, special_bytes: list[bytes], block_bytes: int) -> Iterator[bytes]:
+    """
+    Stream the text that the members starting in [start, end) of compressed file `path` stand for, as
+    blocks of about `block_bytes` cut at safe splits.
+
+    Member boundaries fall anywhere in the text, so the slices of a file are cut at the text instead: a
+    slice owns its text from the first safe split a special token's length past its first member (from
+    the start of the file for the first slice) up to the same split of the next slice, decompressing into
+    the following members as far as needed. first_safe_split sees the same bytes around that split from
+    both sides, so the slices tile the text exactly.
+    """
+    members = compressed_members(path)
+    own = [m for m in members if start <= m[0] < end]
+    after = [m for m in members if m[0] >= end]
+    max_len = max((len(tok) for tok in special_bytes), default=1)
+
+    buf = b""
+    pending, pending_len = [], 0  # chunks not joined into buf yet, as joining each one is quadratic
+    base = 0  # offset of buf[0] in the text of the slice
+    own_len = None
+    head_found = start == 0
+    for chunk in itertools.chain(decode_members(path, own), [None], decode_members(path, after)):
+        if chunk is not None:
+            pending.append(chunk)
+            pending_len += len(chunk)
+            if head_found and own_len is None and len(buf) + pending_len < block_bytes:
+                continue
+        buf = b"".join([buf, *pending])
+        pending, pending_len = [], 0
+        if chunk is None:
+            own_len = base + len(buf)
+            if not after:
+                break
+        if not head_found:
+            cut = first_safe_split(buf, special_bytes, max_len)
+            if cut == -1:
+                continue
+            head_found = True
+            buf, base = buf[cut:], cut
+        if own_len is not None:
+            # buf[0] is a split and nothing between own_len + max_len and it was skipped
+            lo = own_len + max_len - base
+            tail = 0 if lo <= 0 else first_safe_split(buf, special_bytes, lo)
+            if tail != -1:
+                buf = buf[:tail]
+                break
+        while len(buf) >= block_bytes:
+            # stay clear of the split ending the slice
+            limit = len(buf) if own_len is None else min(len(buf), own_len + max_len - base)
+            cut = find_safe_split(buf[:limit], special_bytes)
+            if cut <= 0:
+                break
+            yield buf[:cut]
+            buf, base = buf[cut:], base + cut
+    buf = b"".join([buf, *pending])
+    if head_found and buf:
+        yield buf
+
+
+def iter_stream_jobs(path, special_bytes: list[bytes], job_bytes: int) -> Iterator[Job]:
+    """
+    Decompress `path` in this process and cut its text into jobs of one bytes slice of about `job_bytes`
+    each, at safe splits: the fan-out for a compressed file whose format cannot be split (a plain gzip
+    file, a single bz2 stream). Lazy, so only the jobs in flight are held in memory.
+    """
+    buf = b""
+    for chunk in decode_stream(path, job_bytes):
+        buf += chunk
+        if len(buf) < job_bytes:
+            continue
+        cut = find_safe_split(buf, special_bytes)
+        if cut > 0:
+            yield [buf[:cut]]
+            buf = buf[cut:]
+    if buf:
+        yield [buf]
+
+
+# size of the in-memory jobs a stream is cut into: the parent holds up to a queue's worth of them
+STREAM_BATCH_BYTES = 64 << 20
+
+
+def is_stream_job(job: Job, job_bytes: int) -> bool:
+    # a whole compressed file that cannot be split and is too large for one job
+    if len(job) != 1 or isinstance(job[0], bytes):
+        return False
+    path, start, end = job[0]
+    return is_compressed(path) and end - start > job_bytes and len(compressed_members(path)) == 1
+
+
+def expand_stream_jobs(jobs: list[Job], job_bytes: int, special_bytes: list[bytes],
+                       batch_bytes: int) -> Iterator[Job]:
+    # the jobs, with every stream job replaced by the in-memory jobs of iter_stream_jobs
+    for job in jobs:
+        if is_stream_job(job, job_bytes):
+            yield from iter_stream_jobs(job[0][0], special_bytes, batch_bytes)
+        else:
+            yield job
+
+
+def iter_text_blocks(
+    f: BinaryIO, start: int, end: int, special_bytes: list[bytes], block_bytes: int
+) -> Iterator[str]:
+    """
+    Stream the byte range [start, end) of `f` as decoded text blocks of about `block_bytes` each.
+    Blocks are cut with find_safe_split, so counting pre-tokens per block gives the same totals as
+    counting the whole range at once. A range without any safe cut is read whole.
+    """
+    f.seek(start)
+    pos = start
+    carry = b""
+    while pos < end:
+        block = f.read(min(block_bytes, end - pos))
+        if not block:
+            break
+        pos += len(block)
+        buf = carry + block
+        if pos >= end:
+            carry = buf
+            break
+        cut = find_safe_split(buf, special_bytes)
+        if cut <= 0:
+            carry = buf
+            continue
+        yield buf[:cut].decode("utf-8", errors="ignore")
+        carry = buf[cut:]
+    if carry:
+        yield carry.decode("utf-8", errors="ignore")
+
+
+# Pre-token counts as shipped between processes: every pre-token concatenated into one blob, an int64
+# offsets array (n + 1 entries) into it and an int64 count per pre-token. Three flat bytes objects
+# pickle in one memcpy each instead of one object per pre-token as a Counter does.
+PackedCounts = tuple[bytes, bytes, bytes]
+
+
+def pack_counts(counts: dict[bytes, int]) -> PackedCounts:
+    offsets = array("q", [0])
+    total = 0
+    for word in counts:
+        total += len(word)
+        offsets.append(total)
+    return b"".join(counts), offsets.tobytes(), array("q", counts.values()).tobytes()
+
+
+def iter_packed(packed: PackedCounts) -> Iterator[tuple[bytes, int]]:
+    blob, offsets_bytes, counts_bytes = packed
+    offsets = array("q")
+    offsets.frombytes(offsets_bytes)
+    counts = array("q")
+    counts.frombytes(counts_bytes)
+    offsets = offsets.tolist()
+    return zip((blob[i:j] for i, j in zip(offsets, offsets[1:])), counts.tolist())
+
+
+def unpack_counts(packed: PackedCounts, into: dict[bytes, int] | None = None) -> dict[bytes, int]:
+    if into is None:
+        # pre-tokens are unique within one packed result, so the first table needs no summing
+        return dict(iter_packed(packed))
+    get = into.get
+    for word, count in iter_packed(packed):
+        into[word] = get(word, 0) + count
+    return into
+
+
+def merge_packed(a: PackedCounts, b: PackedCounts) -> PackedCounts:
+    return pack_counts(unpack_counts(b, unpack_counts(a)))
+
+
+def tree_reduce_counts(executor, packed: list[PackedCounts]) -> dict[bytes, int]:
+    """
+    Sum per-worker packed counts pairwise on the pool, log2(n) rounds, instead of folding every worker's
+    Counter into one in the parent. The last two results are merged straight into a dict in the parent.
+    """
+    while len(packed) > 2:
+        futures = [executor.submit(merge_packed, packed[i], packed[i + 1]) for i in range(0, len(packed) - 1, 2)]
+        rest = packed[-1:] if len(packed) % 2 else []
+        packed = [fu.result() for fu in futures] + rest
+
+    counts = None
+    for p in packed:
+        counts = unpack_counts(p, counts)
+    return counts or {}
@@ -1,31 +1,76 @@
-from cs336_basics.train_bpe import train_bpe
-from cs336_basics.utils import now, get_peak_rss_bytes, save_output, get_longest_token, HERE
+import argparse
+
+from cs336_basics.bpe_stats import TrainStats
+from cs336_basics.train_bpe import train_bpe, train_bpe_multi
+from cs336_basics.utils import now, get_peak_rss_bytes, get_children_peak_rss_bytes, save_output, get_longest_token, HERE
+from cs336_basics.worker_pool import BACKENDS, PoolConfig
 
 TINY_STORY_DIR = "tinystories_output"
 OPEN_WEB_DIR = "openweb_output"
 
 
-def train_bpe_tinystories():
+def train_bpe_tinystories(pool: PoolConfig | None = None):
     start = now()
     vocab, merges = train_bpe(HERE.parent / "data/TinyStoriesV2-GPT4-train.txt", 10000,
-                              special_tokens=["<|endoftext|>"])
+                              special_tokens=["<|endoftext|>"], pool=pool)
     elapsed = now() - start
-    print(f"time: {elapsed:.2f}s, peak RSS: {get_peak_rss_bytes() / 1024 / 1024:.2f} MB")
+    print(f"time: {elapsed:.2f}s, peak RSS: {get_peak_rss_bytes() / 1024 / 1024:.2f} MB, "
+          f"largest exited child: {get_children_peak_rss_bytes() / 1024 / 1024:.2f} MB")
 
     save_output(vocab, merges, TINY_STORY_DIR)
 
 
-# TODO: run it non-local, out of memory
-def train_bpe_expts_owt():
+# pre-tokenization holds at most worker_memory of text per worker; the merge loop still holds every unique pre-token.
+# The per-phase peak RSS (parent + workers) in the logged stats is what to size the machine by
+def train_bpe_expts_owt(pool: PoolConfig | None = None):
     start = now()
     vocab, merges = train_bpe(HERE.parent / "data/owt_train.txt", 32000,
-                              special_tokens=["<|endoftext|>"])
+                              special_tokens=["<|endoftext|>"], worker_memory=512 << 20,
+                              stats=TrainStats(rss_interval=0.5), pool=pool)
     elapsed = now() - start
-    print(f"time: {elapsed:.2f}s, peak RSS: {get_peak_rss_bytes() / 1024 / 1024:.2f} MB")
+    print(f"time: {elapsed:.2f}s, peak RSS: {get_peak_rss_bytes() / 1024 / 1024:.2f} MB, "
+          f"largest exited child: {get_children_peak_rss_bytes() / 1024 / 1024:.2f} MB")
 
     save_output(vocab, merges, OPEN_WEB_DIR)
 
 
+# one run to the largest size, a vocab.json/merges.txt per size under tinystories_output/<size>/
+def train_bpe_tinystories_sizes(vocab_sizes=(8000, 10000, 16000, 32000), pool: PoolConfig | None = None):
+    start = now()
+    results = train_bpe_multi(HERE.parent / "data/TinyStoriesV2-GPT4-train.txt", list(vocab_sizes),
+                              special_tokens=["<|endoftext|>"], pool=pool)
+    elapsed = now() - start
+    print(f"time: {elapsed:.2f}s, peak RSS: {get_peak_rss_bytes() / 1024 / 1024:.2f} MB, "
+          f"largest exited child: {get_children_peak_rss_bytes() / 1024 / 1024:.2f} MB")
+
+    for size, (vocab, merges) in results.items():
+        save_output(vocab, merges, f"{TINY_STORY_DIR}/{size}")
+
+
+RUNS = {
+    "tinystories": train_bpe_tinystories,
+    "owt": train_bpe_expts_owt,
+    "tinystories-sizes": train_bpe_tinystories_sizes,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the BPE tokenizers of the assignment.")
+    parser.add_argument("run", nargs="?", choices=RUNS, default="tinystories")
+    parser.add_argument("--backend", choices=BACKENDS, default="process",
+                        help="pre-tokenization workers: processes, or threads matching with the GIL released")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="pool size (default: the CPUs available to this process, cgroup quota included)")
+    parser.add_argument("--start-method", choices=["fork", "forkserver", "spawn"], default=None,
+                        help="process start method (default: the platform's)")
+    parser.add_argument("--persistent", action="store_true", help="reuse one pool across train_bpe calls")
+    args = parser.parse_args()
+
+    pool = PoolConfig(args.backend, args.workers, args.start_method, args.persistent)
+    RUNS[args.run](pool=pool)
+    if args.run == "tinystories":
+        get_longest_token(HERE / TINY_STORY_DIR / "vocab.json")
+
+
 if __name__ == '__main__':
-    train_bpe_tinystories()
-    get_longest_token(HERE / TINY_STORY_DIR / "vocab.json")
+    main()
@@ -2,7 +2,9 @@ import sys
 import regex as re
 from typing import Iterable, Iterator
 
-from cs336_basics.train_bpe import PAT, merge
+from cs336_basics.compressed_input import open_text
+from cs336_basics.pretokenization import pre_token_strings
+from cs336_basics.train_bpe import merge
 from cs336_basics.utils import load_vocab, load_merges, HERE
 
 
@@ -114,11 +116,18 @@ class Tokenizer:
                         yield tok_id
                     continue
 
-                for m in re.finditer(PAT, chunk):
-                    w_byte = m.group(0).encode("utf-8")
+                for token in pre_token_strings(chunk):
+                    w_byte = token.encode("utf-8")
                     for tid in self._encode_word_bytes(w_byte):
                         yield tid
 
+    def encode_file(self, path) -> Iterator[int]:
+        """
+        Stream-encode a text file, plain or compressed (.gz, .xz, .bz2), line by line via encode_iterable.
+        """
+        with open_text(path) as f:
+            yield from self.encode_iterable(f)
+
     def decode(self, ids: list[int]) -> str:
         """
         Decode a sequence of token IDs into text
@@ -1,12 +1,34 @@
-from concurrent.futures.process import ProcessPoolExecutor
-from multiprocessing import cpu_count
+from concurrent.futures import FIRST_COMPLETED, wait
 import collections
+import contextlib
+import functools
+import heapq
+import io
+import itertools
+import logging
+import os
+import tempfile
+import threading
 import regex as re
 assert re.__name__ == "regex"  # sanity check
 
-from cs336_basics.pretokenization_example import find_chunk_boundaries, HERE
-
-PAT = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+from cs336_basics.approx_counts import apply_min_freq, prune_to_capacity
+from cs336_basics.bpe_engine import IntBPE, NumpyBPE, ShardedBPE, _Desc, load_checkpoint, pop_lazy_heap
+from cs336_basics.bpe_stats import TrainStats, profiled
+from cs336_basics.compressed_input import is_compressed
+from cs336_basics.doc_sampling import DocSample, estimate_coverage, sample_jobs
+from cs336_basics.pretokenization import (DEFAULT_WORKER_MEMORY, PAT, STREAM_BATCH_BYTES, block_bytes_for,
+                                          expand_stream_jobs, is_concurrent_matching, is_stream_job,
+                                          iter_member_blocks, iter_text_blocks, pack_counts, plan_jobs,
+                                          pre_token_strings, resolve_inputs, tree_reduce_counts, unpack_counts)
+from cs336_basics.pretoken_cache import cache_path, corpus_fingerprint, load_counts, save_counts
+from cs336_basics.pretoken_spill import (DEFAULT_SPILL_MEMORY, NUM_PARTITIONS, SpilledCounts, merge_partition,
+                                         spill_entries_for, write_runs)
+from cs336_basics.pretokenization_example import HERE
+from cs336_basics.utils import get_children_peak_rss_bytes, get_peak_rss_bytes, now
+from cs336_basics.worker_pool import PoolConfig, open_pool
+
+logger = logging.getLogger(__name__)
 
 
 def init_vocab(sp_tokens) -> dict[int, bytes]:
@@ -16,15 +38,14 @@ def init_vocab(sp_tokens) -> dict[int, bytes]:
     return vocab
 
 
-def pre_tokenize(text: str, special_tokens: set[str]) -> collections.Counter[bytes]:
-    freq_table = collections.Counter()
+def count_pre_token_strings(text: str, special_tokens: set[str], counts: collections.Counter[str]):
+    """
+    Add the pre-tokens of `text` (special tokens included) to `counts`, as str. Counting strings and
+    encoding only the unique ones afterwards (see encode_counts) saves one encode and one bytes hash per
+    match: there are orders of magnitude fewer unique pre-tokens than matches.
+    """
     if special_tokens:
-        # skip the longer tokens first ie ["<docline>", "<doc"]
-        special_sorted = sorted(special_tokens, key=len, reverse=True)
-        # THE outer () is used to keep the special tokens
-        split_keep = re.compile("(" + "|".join(re.escape(t) for t in special_sorted) + ")")
-
-        chunks = split_keep.split(text)
+        chunks = _special_splitter(frozenset(special_tokens)).split(text, concurrent=is_concurrent_matching())
 
     else:
         chunks = [text]
@@ -33,75 +54,552 @@ def pre_tokenize(text: str, special_tokens: set[str]) -> collections.Counter[byt
         if not chunk:
             continue
         if chunk in special_tokens:
-            w_byte = chunk.encode('utf8')
-            freq_table[w_byte] += 1
+            counts[chunk] += 1
         else:
-            for match in re.finditer(PAT, chunk):
-                w_byte = match.group(0).encode('utf8')
-                freq_table[w_byte] += 1
+            # same matches as re.finditer(PAT, chunk), with a faster scan of ASCII text; Counter.update
+            # tallies the whole list in C
+            counts.update(pre_token_strings(chunk))
 
-    return freq_table
 
+@functools.lru_cache(maxsize=16)
+def _special_splitter(special_tokens: frozenset[str]):
+    # compiled once per worker and special-token set instead of once per block
+    # skip the longer tokens first ie ["<docline>", "<doc"]
+    special_sorted = sorted(special_tokens, key=len, reverse=True)
+    # THE outer () is used to keep the special tokens
+    return re.compile("(" + "|".join(re.escape(t) for t in special_sorted) + ")")
 
-def _work_slice(path, start, end, special_tokens) -> collections.Counter[bytes]:
-    with open(path, "rb") as f:
-        f.seek(start)
-        text = f.read(end - start).decode("utf-8", errors="ignore")
-    return pre_tokenize(text, special_tokens)
 
+def encode_counts(counts: collections.Counter[str]) -> collections.Counter[bytes]:
+    return collections.Counter({token.encode('utf8'): cnt for token, cnt in counts.items()})
 
-def train_bpe(input_path: str, vocab_size: int, special_tokens: list[str]) -> tuple[
-    dict[int, bytes], list[tuple[bytes, bytes]]]:
+
+def pre_tokenize(text: str, special_tokens: set[str]) -> collections.Counter[bytes]:
+    counts = collections.Counter()
+    count_pre_token_strings(text, special_tokens, counts)
+    return encode_counts(counts)
+
+
+def _iter_slice_texts(slices, special_tokens, worker_memory, max_block_bytes=None):
+    # stream each slice (see Job) in blocks bounded by worker_memory instead of reading it whole:
+    # with cpu_count() slices of an 11 GB corpus each worker would otherwise hold GBs of text.
+    # max_block_bytes caps them further, for callers bounding how many pre-tokens one block can add
+    special_bytes = [s.encode("utf-8") for s in special_tokens]
+    block_bytes = block_bytes_for(worker_memory)
+    if max_block_bytes is not None:
+        block_bytes = max(1, min(block_bytes, max_block_bytes))
+    for piece in slices:
+        if isinstance(piece, bytes):
+            yield from iter_text_blocks(io.BytesIO(piece), 0, len(piece), special_bytes, block_bytes)
+            continue
+        path, start, end = piece
+        if is_compressed(path):
+            for block in iter_member_blocks(path, start, end, special_bytes, block_bytes):
+                yield block.decode("utf-8", errors="ignore")
+            continue
+        with open(path, "rb") as f:
+            yield from iter_text_blocks(f, start, end, special_bytes, block_bytes)
+
+
+def _work_slices(slices, special_tokens, worker_memory=DEFAULT_WORKER_MEMORY,
+                 max_pre_tokens=None) -> collections.Counter[bytes]:
+    # With max_pre_tokens, only the heavy hitters are kept after each block, and blocks hold at most
+    # max_pre_tokens bytes so the Counter never reaches twice that (see approx_counts)
+    counts = collections.Counter()
+    for text in _iter_slice_texts(slices, special_tokens, worker_memory, max_pre_tokens):
+        count_pre_token_strings(text, special_tokens, counts)
+        if max_pre_tokens is not None:
+            prune_to_capacity(counts, max_pre_tokens)
+    # encode once per unique pre-token, after the whole job
+    return encode_counts(counts)
+
+
+def _work_slice(path, start, end, special_tokens, worker_memory=DEFAULT_WORKER_MEMORY,
+                max_pre_tokens=None) -> collections.Counter[bytes]:
+    return _work_slices([(path, start, end)], special_tokens, worker_memory, max_pre_tokens)
+
+
+def _work_slices_packed(slices, special_tokens, worker_memory=DEFAULT_WORKER_MEMORY, max_pre_tokens=None):
+    return pack_counts(_work_slices(slices, special_tokens, worker_memory, max_pre_tokens))
+
+
+def _work_slices_spilled(slices, special_tokens, worker_memory, spill_dir, spill_memory, tag) -> int:
+    # _work_slices for counts that may not fit in spill_memory: checked after each block, the Counter is
+    # written out as sorted runs and cleared once another block could take it past the limit. A block adds
+    # at most one pre-token per byte, so blocks are cut to a quarter of the limit to leave room for one.
+    # Returns the number of spills
+    limit = spill_entries_for(spill_memory)
+    headroom = max(1, limit // 4)
+    counts = collections.Counter()
+    spills = 0
+    for text in _iter_slice_texts(slices, special_tokens, worker_memory, headroom):
+        count_pre_token_strings(text, special_tokens, counts)
+        if len(counts) > limit - headroom:
+            write_runs(spill_dir, encode_counts(counts), f"{tag}-{spills}")
+            counts.clear()
+            spills += 1
+    if counts:
+        write_runs(spill_dir, encode_counts(counts), f"{tag}-{spills}")
+        spills += 1
+    return spills
+
+
+def _work_job_timed(job_id, slices, special_tokens, worker_memory=DEFAULT_WORKER_MEMORY, profile_dir=None,
+                    spill: tuple[str, int] | None = None, max_pre_tokens=None):
+    # run one job (a list of slices, see plan_jobs) and also report which worker ran it, for how long and
+    # its peak RSS so far, for the per-worker stats. With spill=(spill_dir, spill_memory) the counts go to
+    # run files and the result is the number of spills. The worker is its thread's native id, which is
+    # the pid for a process worker. A thread worker reports no RSS: ru_maxrss is the whole process's
+    started = now()
+    pid = threading.get_native_id()
+    profile_path = None if profile_dir is None else os.path.join(profile_dir, f"pretokenize-{pid}-{job_id}.prof")
+    with profiled(profile_path):
+        if spill is None:
+            result = _work_slices_packed(slices, special_tokens, worker_memory, max_pre_tokens)
+        else:
+            result = _work_slices_spilled(slices, special_tokens, worker_memory, *spill, job_id)
+    rss = get_peak_rss_bytes() if threading.current_thread() is threading.main_thread() else None
+    return pid, now() - started, rss, result
+
+
+def _submit_bounded(executor, jobs, queue_depth, submit):
+    # submit(job_id, slices) for each job with at most queue_depth in flight, yielding each future as it
+    # completes. Jobs are drawn lazily, so they can be produced as the pool consumes them
+    pending = set()
+    todo = enumerate(jobs)
+    while True:
+        for job_id, slices in itertools.islice(todo, queue_depth - len(pending)):
+            pending.add(submit(job_id, slices))
+        if not pending:
+            break
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        yield from done
+
+
+def _run_work_queue(executor, jobs, special_tokens, worker_memory, queue_depth,
+                    profile_dir=None, max_pre_tokens=None) -> tuple[dict[bytes, int], dict[int, float], dict[int, int]]:
+    """
+    Keep at most `queue_depth` jobs in flight and fold each result into the counts as soon as it arrives,
+    in completion order, so one slow job does not hold up the others. Returns the counts, and the busy
+    time and peak RSS of each worker pid.
+    """
+    w_counts: dict[bytes, int] = {}
+    busy: dict[int, float] = collections.defaultdict(float)
+    peak_rss: dict[int, int] = {}
+
+    def submit(job_id, slices):
+        return executor.submit(_work_job_timed, job_id, slices, special_tokens, worker_memory, profile_dir,
+                               max_pre_tokens=max_pre_tokens)
+
+    for fu in _submit_bounded(executor, jobs, queue_depth, submit):
+        pid, elapsed, rss, packed = fu.result()
+        busy[pid] += elapsed
+        if rss is not None:
+            peak_rss[pid] = rss
+        unpack_counts(packed, w_counts)
+    return w_counts, busy, peak_rss
+
+
+def _record_results(stats: TrainStats, results, elapsed: float):
+    busy = collections.defaultdict(float)
+    peak_rss = {}
+    for pid, job_elapsed, rss, _ in results:
+        busy[pid] += job_elapsed
+        if rss is not None:
+            peak_rss[pid] = max(peak_rss.get(pid, 0), rss)
+    stats.record_workers(busy, elapsed, peak_rss)
+
+
+def count_pre_tokens(input_path, special_tokens: set[str], worker_memory: int = DEFAULT_WORKER_MEMORY,
+                     chunk_bytes: int | None = None, queue_depth: int | None = None,
+                     stats: TrainStats | None = None, spill_dir: str | None = None,
+                     spill_memory: int = DEFAULT_SPILL_MEMORY,
+                     max_pre_tokens: int | None = None, sample: DocSample | None = None,
+                     index_dir: str | None = None, pool: PoolConfig | None = None) -> dict[bytes, int] | SpilledCounts:
+    """
+    Pre-tokenize `input_path` in parallel and return the count of every pre-token (special tokens included).
+    `input_path` is a file, a directory (every file below it), a glob or a list of those; see
+    resolve_inputs.
+
+    By default the input is cut into one job per worker and the results are tree-reduced. With
+    `chunk_bytes`, it is cut into jobs of about that size instead, many more than workers, fed through a
+    work queue of at most `queue_depth` in-flight jobs (default: twice the workers) and folded in
+    completion order. Jobs span files: large files are split and small ones batched (see plan_jobs).
+    Phase and per-worker timings go into `stats`.
+
+    .gz, .xz and .bz2 files are read compressed. Workers decompress runs of members where the format has
+    them (see compressed_input); a larger file without members is decompressed by this process and its
+    text handed to the pool in batches, through the work queue.
+
+    With `spill_dir`, the counts are aggregated out of core (see pretoken_spill): each worker keeps its
+    Counter within `spill_memory` (reading smaller blocks so that one cannot overshoot it; text without
+    any safe split is still read whole), spilling sorted runs to a temporary directory under spill_dir, the runs
+    are merged per partition on the pool and a SpilledCounts over the merged files is returned. Its
+    close() removes the directory.
+
+    With `max_pre_tokens`, each job only keeps about that many of its most frequent pre-tokens, so the
+    counts are approximate (see approx_counts); its Counter never holds more than twice that. Not combined
+    with spill_dir.
+
+    With `sample`, only the documents it picks are pre-tokenized (see doc_sampling), their document index
+    kept in `index_dir` if given; what was picked goes into `stats`.
+
+    `pool` picks the executor backend, worker count and start method (see worker_pool.PoolConfig). By
+    default one process per available CPU, affinity and cgroup quota included. The thread backend cannot
+    write per-job profiles (stats.profile_dir) and reports no per-worker peak RSS.
+    """
+    if spill_dir is not None and max_pre_tokens is not None:
+        raise ValueError("max_pre_tokens and spill_dir are alternatives, pick one")
+    stats = TrainStats() if stats is None else stats
+    pool = PoolConfig() if pool is None else pool
+    if pool.backend == "thread" and stats.profile_dir is not None:
+        # one cProfile per job would run several at once in one process, which Python 3.12+ refuses
+        raise ValueError("per-job profiles (stats.profile_dir) need the process backend")
+    paths = resolve_inputs(input_path)
+    total = sum(os.path.getsize(p) for p in paths)
+    num_worker = pool.num_workers()
+    num_chunks = num_worker
+    if chunk_bytes is not None:
+        num_chunks = max(num_worker, -(-total // chunk_bytes))
+
+    # split the files into jobs, on any special token or else a safe whitespace boundary
+    job_bytes = max(1, -(-total // num_chunks))
+    special_bytes = [s.encode("utf-8") for s in special_tokens]
+    with stats.phase("boundaries"):
+        if sample is None:
+            jobs = plan_jobs(paths, job_bytes, special_bytes)
+        else:
+            jobs, picked = sample_jobs(paths, sample, num_worker, chunk_bytes, index_dir)
+            stats.sampled_docs, stats.corpus_docs = picked["sampled_docs"], picked["total_docs"]
+            stats.sampled_bytes, stats.corpus_bytes = picked["sampled_bytes"], picked["total_bytes"]
+    if not jobs:
+        return {}
+    queue_depth = queue_depth or 2 * num_worker
+    streamed = any(is_stream_job(job, job_bytes) for job in jobs)
+    if streamed:
+        # compressed files that cannot be split are decompressed here and fanned out batch by batch as
+        # the pool takes them, which needs the work queue
+        batch_bytes = min(chunk_bytes or STREAM_BATCH_BYTES, block_bytes_for(worker_memory))
+        jobs = expand_stream_jobs(jobs, job_bytes, special_bytes, batch_bytes)
+
+    max_workers = num_worker if streamed else min(num_worker, len(jobs))
+    with open_pool(pool, max_workers, special_tokens) as executor:
+        start = now()
+        if spill_dir is not None:
+            return _count_spilled(executor, jobs, special_tokens, worker_memory, spill_dir, spill_memory,
+                                  queue_depth, stats)
+        if chunk_bytes is not None or streamed:
+            # results are folded in as they arrive, so the reduction is part of this phase
+            with stats.phase("pre_tokenize"):
+                w_counts, busy, peak_rss = _run_work_queue(executor, jobs, special_tokens, worker_memory,
+                                                           queue_depth, stats.profile_dir, max_pre_tokens)
+            stats.record_workers(busy, now() - start, peak_rss)
+            return w_counts
+
+        with stats.phase("pre_tokenize"):
+            futures = [executor.submit(_work_job_timed, job_id, slices, special_tokens, worker_memory,
+                                       stats.profile_dir, max_pre_tokens=max_pre_tokens)
+                       for job_id, slices in enumerate(jobs)]
+            results = [fu.result() for fu in futures]
+        _record_results(stats, results, now() - start)
+
+        with stats.phase("reduce"):
+            w_counts = tree_reduce_counts(executor, [packed for *_, packed in results])
+        del results
+    return w_counts
+
+
+def _count_spilled(executor, jobs, special_tokens, worker_memory, spill_dir, spill_memory, queue_depth,
+                   stats: TrainStats) -> SpilledCounts:
+    os.makedirs(spill_dir, exist_ok=True)
+    tmp_dir = tempfile.TemporaryDirectory(dir=spill_dir, prefix="bpe-spill-")
+    start = now()
+
+    def submit(job_id, slices):
+        return executor.submit(_work_job_timed, job_id, slices, special_tokens, worker_memory,
+                               stats.profile_dir, (tmp_dir.name, spill_memory))
+
+    try:
+        with stats.phase("pre_tokenize"):
+            # results are just spill counts; the queue only bounds the jobs read ahead of the pool
+            results = [fu.result() for fu in _submit_bounded(executor, jobs, queue_depth, submit)]
+        _record_results(stats, results, now() - start)
+        logger.info("spilled %d runs to %s", sum(spills for *_, spills in results), tmp_dir.name)
+
+        with stats.phase("reduce"):
+            parts = executor.map(merge_partition, itertools.repeat(tmp_dir.name), range(NUM_PARTITIONS))
+            return SpilledCounts([p for p in parts if p is not None], tmp_dir)
+    except BaseException:
+        tmp_dir.cleanup()
+        raise
+
+
+def _load_pre_token_counts(input_path, special_tokens: set[str], cache_dir: str | None,
+                           stats: TrainStats | None = None, **count_kwargs) -> dict[bytes, int]:
+    stats = TrainStats() if stats is None else stats
+    if count_kwargs.get("sample") is not None:
+        # a sample is cheap to count and not cached; the document index is
+        w_counts = count_pre_tokens(input_path, special_tokens, stats=stats, index_dir=cache_dir, **count_kwargs)
+        stats.sample_coverage = estimate_coverage(w_counts)
+        logger.info("sampled %d of %d documents (%.1f%% of bytes), estimated coverage %.3f",
+                    stats.sampled_docs, stats.corpus_docs, 100 * stats.sampled_bytes / max(1, stats.corpus_bytes),
+                    stats.sample_coverage)
+        return w_counts
+    if cache_dir is None or count_kwargs.get("max_pre_tokens") is not None:
+        # approximate counts are never cached, the cache key only covers the corpus
+        return count_pre_tokens(input_path, special_tokens, stats=stats, **count_kwargs)
+    with stats.phase("cache"):
+        path = cache_path(cache_dir, corpus_fingerprint(input_path, special_tokens, PAT))
+        hit = path.exists()
+        if hit and count_kwargs.get("spill_dir") is not None:
+            # out of core: read the cache file as it is, never as a dict
+            return SpilledCounts([path])
+        if hit:
+            w_counts = load_counts(path)
+            logger.info("loaded %d pre-token counts from %s", len(w_counts), path)
+    if not hit:
+        w_counts = count_pre_tokens(input_path, special_tokens, stats=stats, **count_kwargs)
+        with stats.phase("cache"):
+            if isinstance(w_counts, SpilledCounts):
+                w_counts.save(path)
+            else:
+                save_counts(path, w_counts)
+    return w_counts
+
+
+def train_bpe(input_path: str | list[str], vocab_size: int, special_tokens: list[str], engine: str = "int",
+              worker_memory: int = DEFAULT_WORKER_MEMORY, cache_dir: str | None = None,
+              checkpoint_path: str | None = None, checkpoint_every: int = 1000, merge_workers: int = 1,
+              chunk_bytes: int | None = None, queue_depth: int | None = None,
+              stats: TrainStats | None = None, spill_dir: str | None = None,
+              spill_memory: int = DEFAULT_SPILL_MEMORY, max_pre_tokens: int | None = None,
+              min_freq: int = 1, sample: DocSample | None = None,
+              pool: PoolConfig | None = None) -> tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
+    """
+    input_path: a file, a directory, a glob or a list of those (see pretokenization.resolve_inputs). Every
+    file is pre-tokenized on its own, as if separated by a document boundary, and the work is scheduled
+    across all of them.
+    engine: "int" runs the merge loop on interned integer ids (IntBPE), "numpy" on flat numpy arrays with
+    vectorized pair counting and merging (NumpyBPE), "tuple" on tuples of bytes. All produce identical
+    merges.
+    worker_memory: per-worker budget in bytes for the text held during pre-tokenization.
+    cache_dir: if given, pre-token counts are stored there keyed by corpus fingerprint, and later runs
+    on the same corpus, PAT and special tokens skip pre-tokenization.
+    checkpoint_path: if given (int and numpy engines), the merge loop state is saved there every
+    `checkpoint_every` merges and at the end. Continue it with resume_train_bpe().
+    merge_workers: with more than one (int engine, no checkpoints), the words are sharded across that many
+    processes for the merge loop (ShardedBPE). The merges are the same.
+    chunk_bytes, queue_depth: pre-tokenize through a work queue of slices of about chunk_bytes instead of
+    one slice per worker; see count_pre_tokens.
+    stats: a TrainStats to fill in with per-phase timings and memory (and cProfile dumps if its profile_dir
+        is set).
+    spill_dir, spill_memory: aggregate the pre-token counts on disk under spill_dir, each worker holding at
+    most spill_memory bytes of counts, for corpora whose unique pre-tokens do not fit in memory; see
+    count_pre_tokens. The merge engine still holds every unique pre-token.
+    max_pre_tokens, min_freq: approximate training (see approx_counts). Each pre-tokenization job keeps
+    only its ~max_pre_tokens most frequent pre-tokens, and pre-tokens seen fewer than min_freq times
+    are dropped before the pair counts. The bound is per job, not on the merged counts: with N jobs
+    those can hold up to N * max_pre_tokens pre-tokens. Check the effect with approx_counts.merge_divergence.
+    sample: train on a reproducible sample of the documents only, e.g. DocSample(every=10) or
+    DocSample(fraction=0.01, seed=1); see doc_sampling. The sample's size and estimated coverage of the
+    corpus's pre-tokens go into stats. Sampled counts are not cached, the document index is (cache_dir).
+    pool: the pre-tokenization executor, e.g. PoolConfig(workers=4, start_method="forkserver",
+    persistent=True) or PoolConfig(backend="thread"); see worker_pool.
+    """
+    stats = TrainStats() if stats is None else stats
     vocab = init_vocab(special_tokens)
     max_merge = vocab_size - len(vocab)
 
+    special_list = list(special_tokens)
     special_tokens = set(special_tokens)
-    merges: list[tuple[bytes, bytes]] = []
-    w_counts: collections.Counter[bytes] = collections.Counter()
-    num_worker = cpu_count()
+    if checkpoint_path is not None and (engine not in ("int", "numpy") or merge_workers > 1):
+        raise ValueError("checkpoints are only supported by the single-process int and numpy engines")
+    if merge_workers > 1 and engine != "int":
+        raise ValueError("merge_workers > 1 is only supported by the int engine")
+    w_counts = _load_pre_token_counts(input_path, special_tokens, cache_dir, stats, worker_memory=worker_memory,
+                                      chunk_bytes=chunk_bytes, queue_depth=queue_depth, spill_dir=spill_dir,
+                                      spill_memory=spill_memory, max_pre_tokens=max_pre_tokens, sample=sample,
+                                      pool=pool)
+    with contextlib.ExitStack() as spilled:
+        # spilled counts are read once, into the engine (or by min_freq): their files are removed as soon
+        # as it is built, by spilled.close(), or on the way out if anything fails first
+        if isinstance(w_counts, SpilledCounts):
+            spilled.enter_context(w_counts)
+        if min_freq > 1:
+            with stats.phase("min_freq"):
+                w_counts, stats.pruned_pre_tokens, stats.pruned_occurrences = apply_min_freq(
+                    w_counts, min_freq, special_tokens)
+            logger.info("min_freq=%d dropped %d unique pre-tokens (%d occurrences)", min_freq,
+                        stats.pruned_pre_tokens, stats.pruned_occurrences)
+        stats.pre_tokens = len(w_counts)
+
+        # finished pool workers only show up in RUSAGE_CHILDREN once the pool is shut down, i.e. by now. It is
+        # a maximum over the process lifetime, not this run (see TrainStats)
+        stats.children_peak_rss = get_children_peak_rss_bytes()
+
+        with profiled(stats.profile_path("merges")), stats.traced():
+            if engine == "int" and merge_workers > 1:
+                with stats.phase("pair_counts"):
+                    bpe = ShardedBPE(w_counts, special_tokens, merge_workers)
+                del w_counts
+                spilled.close()
+                stats.snapshot()
+                with bpe, stats.phase("merges"):
+                    merges = bpe.run(max_merge, stats=stats)
+            elif engine == "int":
+                with stats.phase("pair_counts"):
+                    bpe = IntBPE(w_counts, special_tokens)
+                del w_counts
+                spilled.close()
+                stats.snapshot()
+                with stats.phase("merges"):
+                    merges = bpe.run(max_merge, checkpoint_path, checkpoint_every,
+                                     {"special_tokens": special_list}, stats=stats)
+            elif engine == "numpy":
+                with stats.phase("pair_counts"):
+                    bpe = NumpyBPE(w_counts, special_tokens)
+                del w_counts
+                spilled.close()
+                stats.snapshot()
+                with stats.phase("merges"):
+                    merges = bpe.run(max_merge, checkpoint_path, checkpoint_every,
+                                     {"special_tokens": special_list}, stats=stats)
+            elif engine == "tuple":
+                merges = _merge_tuples(w_counts, special_tokens, max_merge, stats)
+            else:
+                raise ValueError(f"unknown engine: {engine}")
+
+    for a, b in merges:
+        vocab[len(vocab)] = a + b
+    logger.info("train_bpe phases:\n%s", stats.summary())
+    return vocab, merges
 
-    # read the file and split them into chunks
-    with open(input_path, "rb") as f:
-        boundaries = find_chunk_boundaries(f, num_worker, '<|endoftext|>'.encode('utf8'))
 
-    jobs = list(zip(boundaries[:-1], boundaries[1:]))
+def truncate_bpe(vocab: dict[int, bytes], merges: list[tuple[bytes, bytes]], num_special: int,
+                 vocab_size: int) -> tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
+    """
+    The vocab/merges a train_bpe run to `vocab_size` would have produced, cut from a run to a larger size:
+    merges come out in order, so a smaller run is a prefix of a larger one.
+    """
+    num_merges = max(0, vocab_size - 256 - num_special)
+    merges = merges[:num_merges]
+    return {i: t for i, t in vocab.items() if i < 256 + num_special + len(merges)}, merges
+
+
+def train_bpe_multi(input_path: str, vocab_sizes: list[int], special_tokens: list[str],
+                    **kwargs) -> dict[int, tuple[dict[int, bytes], list[tuple[bytes, bytes]]]]:
+    """
+    Train once to the largest of `vocab_sizes` and return {vocab_size: (vocab, merges)} for every size,
+    at the cost of a single run. kwargs are passed on to train_bpe.
+    """
+    vocab, merges = train_bpe(input_path, max(vocab_sizes), special_tokens, **kwargs)
+    return {size: truncate_bpe(vocab, merges, len(special_tokens), size) for size in vocab_sizes}
+
+
+def resume_train_bpe(checkpoint_path: str, vocab_size: int, checkpoint_every: int = 1000,
+                     engine: str = "int") -> tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
+    """
+    Continue a train_bpe(checkpoint_path=...) run from its last checkpoint up to `vocab_size`. The
+    checkpoint written at the end of a finished run works too, which extends it (e.g. 10k -> 32k)
+    without pre-tokenizing or merging again. `engine` ("int" or "numpy") need not be the one that wrote it.
+    """
+    engines = {"int": IntBPE, "numpy": NumpyBPE}
+    if engine not in engines:
+        raise ValueError(f"unknown engine: {engine}")
+    bpe, state = load_checkpoint(checkpoint_path, engines[engine])
+    special_tokens = state["special_tokens"]
+    vocab = init_vocab(special_tokens)
+    merges = bpe.run(vocab_size - len(vocab), checkpoint_path, checkpoint_every, state)
+    # a checkpoint taken past vocab_size is cut back
+    merges = merges[:vocab_size - len(vocab)]
+    for a, b in merges:
+        vocab[len(vocab)] = a + b
+    return vocab, merges
 
-    # multi process 1490 ms train_bpe(), pre_tokenize is not bottleneck
-    with ProcessPoolExecutor(max_workers=min(num_worker, len(jobs))) as executor:
-        futures = [executor.submit(_work_slice, input_path, start, end, special_tokens) for start, end in jobs]
-        for fu in futures:
-            w_counts.update(fu.result())
-    # single process: pre_tokenize 1271 ms / 2185 ms 58% of train_bpe()
-    # w_counts = pre_tokenize(text, special_tokens)
 
-    w_freq = {
-        tuple(bytes([b]) for b in word): cnt for word, cnt in w_counts.items()
-    }
+def extend_bpe(input_path: str, vocab: dict[int, bytes], merges: list[tuple[bytes, bytes]], vocab_size: int,
+               special_tokens: list[str], worker_memory: int = DEFAULT_WORKER_MEMORY,
+               cache_dir: str | None = None) -> tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
+    """
+    Grow an existing vocab/merges pair (e.g. loaded with utils.load_vocab/load_merges) to `vocab_size`.
+    The earlier merges are replayed per unique pre-token instead of re-running the merge loop, and with
+    `cache_dir` the pre-token counts come from the cache. New tokens get ids after the existing ones.
+    """
+    special_tokens = set(special_tokens)
+    w_counts = _load_pre_token_counts(input_path, special_tokens, cache_dir, worker_memory=worker_memory)
+    bpe = IntBPE.from_merges(w_counts, special_tokens, merges)
+    del w_counts
+
+    # utils.load_vocab keeps the json string keys
+    vocab = {int(k): v for k, v in vocab.items()}
+    num_old = len(merges)
+    merges = bpe.run(num_old + vocab_size - len(vocab))
+    next_id = max(vocab, default=-1) + 1
+    for a, b in merges[num_old:]:
+        vocab[next_id] = a + b
+        next_id += 1
+    return vocab, merges
 
-    sp_token_tuple = {
-        tuple(bytes([b]) for b in s.encode('utf-8')) for s in special_tokens
-    }
 
-    pair2word = collections.defaultdict(set)
-    p_freq, pair2word = get_pair_freq(w_freq, sp_token_tuple, pair2word)
+def _merge_tuples(w_counts, special_tokens, max_merge, stats: TrainStats | None = None) -> list[tuple[bytes, bytes]]:
+    stats = TrainStats() if stats is None else stats
+    merges: list[tuple[bytes, bytes]] = []
+    with stats.phase("pair_counts"):
+        w_freq = {
+            tuple(bytes([b]) for b in word): cnt for word, cnt in w_counts.items()
+        }
+
+        sp_token_tuple = {
+            tuple(bytes([b]) for b in s.encode('utf-8')) for s in special_tokens
+        }
+
+        pair2word = collections.defaultdict(set)
+        p_freq, pair2word = get_pair_freq(w_freq, sp_token_tuple, pair2word)
+        # lazy max-heap over p_freq: 32k full max() scans over millions of pairs was the merge loop bottleneck
+        heap = build_pair_heap(p_freq)
+    stats.snapshot()
+
+    start = now()
+    with stats.phase("merges"):
+        for i in range(max_merge):
+            highest_pair = pop_most_frequent_pair(heap, p_freq)
+            if highest_pair is None:
+                break
+            merges.append(highest_pair)
+
+            changed = update_freq(p_freq, pair2word, highest_pair, w_freq)
+            for pair in changed:
+                if pair in p_freq:
+                    push_pair(heap, pair, p_freq[pair])
+            if len(merges) % stats.sample_every == 0:
+                stats.merge_samples.append((len(merges), now() - start))
+    stats.merge_samples.append((len(merges), now() - start))
+
+    return merges
 
-    for i in range(max_merge):
-        if not p_freq:
-            break
 
-        highest_pair = get_most_frequent_pair(p_freq)
+def get_most_frequent_pair(freq):
+    return max(freq, key=lambda p: (freq[p], p))
 
-        new_token = highest_pair[0] + highest_pair[1]
-        merges.append(highest_pair)
-        vocab[len(vocab)] = new_token
 
-        update_freq(p_freq, pair2word, highest_pair, w_freq)
+def push_pair(heap, pair, count):
+    # entries are (-count, _Desc(pair), pair): highest count first, ties go to the largest byte pair
+    heapq.heappush(heap, (-count, _Desc(pair), pair))
 
-    return vocab, merges
 
+def build_pair_heap(p_freq):
+    heap = [(-count, _Desc(pair), pair) for pair, count in p_freq.items()]
+    heapq.heapify(heap)
+    return heap
 
-def get_most_frequent_pair(freq):
-    return max(freq, key=lambda p: (freq[p], p))
+
+def pop_most_frequent_pair(heap, p_freq):
+    """
+    Same tie-break as get_most_frequent_pair, but entries are invalidated lazily: counts changed by
+    update_freq are pushed again, and an entry is stale when its count no longer matches p_freq.
+    Returns None once the heap is exhausted.
+    """
+    return pop_lazy_heap(heap, p_freq)
 
 
 def get_pair_freq(w_freq, special_tk, pair2word):
@@ -116,33 +614,69 @@ def get_pair_freq(w_freq, special_tk, pair2word):
     return freq, pair2word
 
 
-def update_freq(p_freq, pair2word, highest_pair, w_freq):
+def update_freq(p_freq, pair2word, highest_pair, w_freq) -> list:
+    """
+    Apply `highest_pair` to every word containing it, and return the pairs whose count changed.
+
+    Only the pairs next to a merge site change count: (left, a) -> (left, ab) and (b, right) -> (ab, right),
+    so the rest of the word is left alone. pair2word is still keyed by the word tuple, which changes
+    identity on merge, so the word is moved to its new tuple in every set.
+    """
+    a, b = highest_pair
+    ab = a + b
+    delta = collections.defaultdict(int)
     to_processed = list(pair2word.pop(highest_pair))
     for word in to_processed:
         if word not in w_freq:
             continue
 
         count = w_freq.pop(word)
-        for pair in zip(word[:-1], word[1:]):
-            if pair in p_freq:
-                p_freq[pair] = p_freq.get(pair, 0) - count
-                if p_freq[pair] == 0:
-                    del p_freq[pair]
+        new_word = local_merge(word, a, b, ab, count, delta)
+        w_freq[new_word] = w_freq.get(new_word, 0) + count
+
         for pair in set(zip(word[:-1], word[1:])):
             if pair in pair2word:
                 pair2word[pair].discard(word)
                 if not pair2word[pair]:
                     del pair2word[pair]
+        for pair in zip(new_word[:-1], new_word[1:]):
+            pair2word[pair].add(new_word)
 
-        new_word = merge(word, highest_pair)
-        w_freq[new_word] = w_freq.get(new_word, 0) + count
-
-        if len(new_word) < 2:
+    changed = []
+    for pair, d in delta.items():
+        if not d:
             continue
+        p_freq[pair] += d
+        if p_freq[pair] == 0:
+            del p_freq[pair]
+        changed.append(pair)
+    return changed
 
-        for pair in zip(new_word[:-1], new_word[1:]):
-            p_freq[pair] += count
-            pair2word[pair].add(new_word)
+
+def local_merge(w, a, b, ab, count, delta):
+    """
+    merge() that also records the pair count changes around each merge site into `delta`.
+    """
+    updated_word = []
+    i = 0
+    n = len(w)
+    while i < n:
+        if i < n - 1 and w[i] == a and w[i + 1] == b:
+            delta[(a, b)] -= count
+            if updated_word:
+                # the left token is `ab` itself when the previous merge site is directly adjacent
+                delta[(w[i - 1], a)] -= count
+                delta[(updated_word[-1], ab)] += count
+            # a right neighbour that starts the next merge site is handled as that site's left side
+            if i + 2 < n and not (w[i + 2] == a and i + 3 < n and w[i + 3] == b):
+                delta[(b, w[i + 2])] -= count
+                delta[(ab, w[i + 2])] += count
+            updated_word.append(ab)
+            i += 2
+        else:
+            updated_word.append(w[i])
+            i += 1
+    return tuple(updated_word)
 
 
 def merge(w, pair) -> tuple[bytes]:
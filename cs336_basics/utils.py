@@ -20,19 +20,33 @@ def now():
     return time.perf_counter()
 
 
-def get_peak_rss_bytes():
+def _max_rss_bytes(who):
     # Cross-platform best-effort:
     # - Linux: resource.ru_maxrss is in kilobytes
     # - macOS: ru_maxrss is in bytes
+    import resource
+    peak = resource.getrusage(who).ru_maxrss
+    # Heuristic: assume KB on Linux (most common), bytes on macOS
+    if sys.platform == "darwin":
+        return int(peak)  # bytes
+    else:
+        return int(peak) * 1024  # KB -> bytes
+
+
+def get_children_peak_rss_bytes():
+    # peak RSS of the largest child process that has exited and been waited for (e.g. pool workers after
+    # the pool is shut down); not the sum over children
+    try:
+        import resource
+        return _max_rss_bytes(resource.RUSAGE_CHILDREN)
+    except Exception:
+        return -1
+
+
+def get_peak_rss_bytes():
     try:
         import resource
-        rusage = resource.getrusage(resource.RUSAGE_SELF)
-        peak = rusage.ru_maxrss
-        # Heuristic: assume KB on Linux (most common), bytes on macOS
-        if sys.platform == "darwin":
-            return int(peak)  # bytes
-        else:
-            return int(peak) * 1024  # KB -> bytes
+        return _max_rss_bytes(resource.RUSAGE_SELF)
     except Exception:
         # Fallback to psutil current RSS (not true peak, but better than nothing)
         try:
@@ -43,6 +57,7 @@ def get_peak_rss_bytes():
 
 
 def save_output(vocab: dict[int, bytes], merges: list[tuple[bytes, bytes]], output_dir: str):
+    (HERE / output_dir).mkdir(parents=True, exist_ok=True)
     serializable_vocab = {k: list(v) for k, v in vocab.items()}
     with open(HERE / output_dir / VOCAB_FILE, "w", encoding="utf-8") as f:
         json.dump(serializable_vocab, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,127 @@
+import atexit
+import collections
+import contextlib
+import math
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+
+from cs336_basics.pretokenization import use_concurrent_matching
+
+BACKENDS = ("process", "thread")
+
+
+def _cgroup_cpu_quota() -> float | None:
+    # CPUs' worth of time the cgroup may use (cgroup v2 cpu.max, else v1 cfs quota), None if unlimited
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus() -> int:
+    """
+    CPUs this process can actually use: its affinity mask (taskset, cpusets), capped by a cgroup CPU quota
+    (docker --cpus, k8s limits). cpu_count() reports every CPU of the host either way.
+    """
+    try:
+        n = len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        n = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        n = min(n, max(1, math.ceil(quota)))
+    return n
+
+
+@dataclass(frozen=True)
+class PoolConfig:
+    """
+    How train_bpe runs pre-tokenization.
+
+    backend: "process" for a ProcessPoolExecutor, or "thread" for a ThreadPoolExecutor whose workers
+    match with regex's concurrent=True, which releases the GIL during each match. Counting the matches
+    still holds it, so threads gain less than processes but start instantly and share memory.
+    workers: pool size, by default available_cpus().
+    start_method: "fork", "forkserver" or "spawn" for the process backend, None for the platform default.
+    forkserver preloads train_bpe in the server, so each worker starts with it imported.
+    persistent: keep the pool alive across train_bpe calls (until shutdown_pools() or exit) instead of
+    starting one per call.
+    """
+    backend: str = "process"
+    workers: int | None = None
+    start_method: str | None = None
+    persistent: bool = False
+
+    def __post_init__(self):
+        if self.backend not in BACKENDS:
+            raise ValueError(f"unknown backend {self.backend!r}, expected one of {BACKENDS}")
+        if self.workers is not None and self.workers < 1:
+            raise ValueError("workers must be at least 1")
+        if self.start_method is not None:
+            if self.backend != "process":
+                raise ValueError("start_method only applies to the process backend")
+            if self.start_method not in multiprocessing.get_all_start_methods():
+                raise ValueError(f"start method {self.start_method!r} is not available here")
+
+    def num_workers(self) -> int:
+        return self.workers or available_cpus()
+
+
+_POOLS: dict[PoolConfig, Executor] = {}
+
+
+def _init_worker(special_tokens: tuple[str, ...], concurrent: bool):
+    # import and compile everything pre-tokenization needs before the first job rather than in it
+    from cs336_basics.train_bpe import count_pre_token_strings
+
+    if concurrent:
+        use_concurrent_matching()
+    count_pre_token_strings("Warm up: the regexes, 123 ünïcode!\n", set(special_tokens), collections.Counter())
+
+
+def _new_pool(config: PoolConfig, max_workers: int, special_tokens) -> Executor:
+    initargs = (tuple(sorted(special_tokens)), config.backend == "thread")
+    if config.backend == "thread":
+        return ThreadPoolExecutor(max_workers, initializer=_init_worker, initargs=initargs)
+    ctx = multiprocessing.get_context(config.start_method)
+    if config.start_method == "forkserver":
+        ctx.set_forkserver_preload(["cs336_basics.train_bpe"])
+    return ProcessPoolExecutor(max_workers, mp_context=ctx, initializer=_init_worker, initargs=initargs)
+
+
+@contextlib.contextmanager
+def open_pool(config: PoolConfig, max_workers: int, special_tokens):
+    """
+    An executor for `config`: a new one of max_workers, shut down on exit, or the persistent one for
+    config (of config.num_workers()), started on first use and left running.
+    """
+    if not config.persistent:
+        with _new_pool(config, max_workers, special_tokens) as executor:
+            yield executor
+        return
+    executor = _POOLS.get(config)
+    if executor is None or getattr(executor, "_broken", False):
+        executor = _POOLS[config] = _new_pool(config, config.num_workers(), special_tokens)
+    yield executor
+
+
+def shutdown_pools():
+    # shut down every persistent pool
+    while _POOLS:
+        _, executor = _POOLS.popitem()
+        executor.shutdown()
+
+
+atexit.register(shutdown_pools)
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
+import gzip
 import json
+import lzma
 import os
 import resource
 import sys
@@ -413,6 +415,25 @@ def test_encode_iterable_tinystories_matches_tiktoken():
     assert reference_tokenizer.decode(reference_ids) == corpus_contents
 
 
+def test_encode_file_plain_and_compressed(tmp_path):
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH, merges_path=MERGES_PATH, special_tokens=["<|endoftext|>"]
+    )
+    corpus = (FIXTURES_PATH / "tinystories_sample.txt").read_bytes()
+    # line endings are kept as they are, not translated to \n
+    crlf = "one line\r\nanother\rlast\r\n\r\n<|endoftext|>\r\nend".encode()
+    files = {
+        "corpus.txt.gz": gzip.compress(corpus),
+        "corpus.txt.xz": lzma.compress(corpus),
+        "crlf.txt": crlf,
+        "crlf.txt.gz": gzip.compress(crlf),
+    }
+    for name, blob in files.items():
+        (tmp_path / name).write_bytes(blob)
+        text = (corpus if name.startswith("corpus") else crlf).decode("utf-8")
+        assert list(tokenizer.encode_file(tmp_path / name)) == tokenizer.encode(text)
+
+
 @pytest.mark.skipif(
     not sys.platform.startswith("linux"),
     reason="rlimit support for non-linux systems is spotty.",
@@ -1,10 +1,42 @@
+import bz2
+import gzip
 import json
+import lzma
+import os
 import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+import regex
+
+from cs336_basics.approx_counts import merge_divergence
+from cs336_basics.bench_bpe import compare_to_baseline
+from cs336_basics.bpe_engine import ShardedBPE
+from cs336_basics.bpe_example import toy_bpe
+from cs336_basics.bpe_stats import TrainStats
+from cs336_basics.compressed_input import compressed_members
+from cs336_basics.doc_sampling import DocSample
+from cs336_basics.pretoken_spill import SpilledCounts
+from cs336_basics.pretokenization import (PAT, find_chunk_boundaries, pack_counts, plan_jobs, pre_token_strings,
+                                          resolve_inputs, tree_reduce_counts, unpack_counts)
+from cs336_basics.train_bpe import (_work_slice, build_pair_heap, count_pre_tokens, extend_bpe,
+                                    get_most_frequent_pair, pop_most_frequent_pair, push_pair, resume_train_bpe,
+                                    train_bpe, train_bpe_multi)
+from cs336_basics.worker_pool import PoolConfig, available_cpus, shutdown_pools
 
 from .adapters import run_train_bpe
 from .common import FIXTURES_PATH, gpt2_bytes_to_unicode
 
 
+@pytest.fixture(scope="module")
+def corpus_en_bpe():
+    """
+    train_bpe on corpus.en to 500 with default settings: the result every option below must reproduce.
+    """
+    return train_bpe(FIXTURES_PATH / "corpus.en", 500, ["<|endoftext|>"])
+
+
 def test_train_bpe_speed():
     """
     Ensure that BPE training is relatively efficient by measuring training
@@ -86,3 +118,314 @@ def test_train_bpe_special_tokens(snapshot):
             "merges": merges,
         },
     )
+
+
+def test_pair_heap_matches_max_scan():
+    """
+    The lazy heap must pick the same pair as a full max() scan, including the
+    lexicographically-greatest tie-break, after counts have been changed.
+    """
+    p_freq = {(b"a", b"b"): 3, (b"b", b"c"): 3, (b"c", b"d"): 1, (b" ", b"t"): 2}
+    heap = build_pair_heap(p_freq)
+    p_freq[(b"c", b"d")] = 3
+    push_pair(heap, (b"c", b"d"), 3)
+    while p_freq:
+        expected = get_most_frequent_pair(p_freq)
+        assert pop_most_frequent_pair(heap, p_freq) == expected
+        del p_freq[expected]
+    assert pop_most_frequent_pair(heap, p_freq) is None
+
+
+def test_train_bpe_engines_agree(corpus_en_bpe):
+    vocab, merges = corpus_en_bpe
+    vocab_tuple, merges_tuple = train_bpe(FIXTURES_PATH / "corpus.en", 500, ["<|endoftext|>"], engine="tuple")
+    assert merges == merges_tuple
+    assert vocab == vocab_tuple
+
+
+def test_train_bpe_numpy_engine(corpus_en_bpe):
+    input_path = FIXTURES_PATH / "corpus.en"
+    gpt2_byte_decoder = {v: k for k, v in gpt2_bytes_to_unicode().items()}
+    with open(FIXTURES_PATH / "train-bpe-reference-merges.txt", encoding="utf-8") as f:
+        reference_merges = [
+            tuple(bytes([gpt2_byte_decoder[token] for token in part]) for part in line.rstrip().split(" "))
+            for line in f
+        ]
+    vocab, merges = train_bpe(input_path, 500, ["<|endoftext|>"], engine="numpy")
+    assert merges == reference_merges
+    assert (vocab, merges) == corpus_en_bpe
+
+
+def test_train_bpe_streamed_slices(corpus_en_bpe):
+    """
+    Workers streaming their slice in tiny blocks must count the same pre-tokens as reading it whole.
+    """
+    input_path = FIXTURES_PATH / "corpus.en"
+    vocab, merges = corpus_en_bpe
+    vocab_streamed, merges_streamed = train_bpe(input_path, 500, ["<|endoftext|>"], worker_memory=4096)
+    assert merges == merges_streamed
+    assert vocab == vocab_streamed
+
+
+def test_packed_counts_tree_reduce():
+    tables = [Counter({b"the": i + 1, b" cat": 2, "é".encode(): i, b"": 1}) for i in range(5)]
+    tables.append(Counter({b" dog": 7}))
+    expected = sum(tables, Counter())
+    assert unpack_counts(pack_counts(tables[0])) == tables[0]
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert tree_reduce_counts(executor, [pack_counts(t) for t in tables]) == expected
+
+
+def test_train_bpe_pre_token_cache(tmp_path, corpus_en_bpe):
+    input_path = FIXTURES_PATH / "corpus.en"
+    cold = train_bpe(input_path, 500, ["<|endoftext|>"], cache_dir=tmp_path)
+    assert len(list(tmp_path.iterdir())) == 1
+    stats = TrainStats()
+    warm = train_bpe(input_path, 500, ["<|endoftext|>"], cache_dir=tmp_path, stats=stats)
+    assert cold == warm == corpus_en_bpe
+    # the warm run loaded the counts instead of pre-tokenizing again
+    assert "cache" in stats.phases and "pre_tokenize" not in stats.phases
+
+    # a different special-token set is a different cache entry
+    train_bpe(input_path, 300, ["<|endoftext|>", "<pad>"], cache_dir=tmp_path)
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_train_bpe_resume_and_extend(tmp_path, corpus_en_bpe):
+    input_path = FIXTURES_PATH / "corpus.en"
+    checkpoint = tmp_path / "bpe.ckpt"
+    train_bpe(input_path, 300, ["<|endoftext|>"], checkpoint_path=checkpoint, checkpoint_every=10)
+    assert resume_train_bpe(checkpoint, 500) == corpus_en_bpe
+    # the numpy engine writes the same checkpoints, and either engine continues them
+    train_bpe(input_path, 300, ["<|endoftext|>"], engine="numpy", checkpoint_path=checkpoint, checkpoint_every=10)
+    assert resume_train_bpe(checkpoint, 500, engine="numpy") == corpus_en_bpe
+    train_bpe(input_path, 300, ["<|endoftext|>"], engine="numpy", checkpoint_path=checkpoint)
+    assert resume_train_bpe(checkpoint, 500) == corpus_en_bpe
+
+    small_vocab, small_merges = train_bpe(input_path, 400, ["<|endoftext|>"])
+    assert extend_bpe(input_path, small_vocab, small_merges, 500, ["<|endoftext|>"]) == corpus_en_bpe
+
+
+def test_train_bpe_multi_sizes():
+    input_path = FIXTURES_PATH / "corpus.en"
+    results = train_bpe_multi(input_path, [300, 500, 400], ["<|endoftext|>"])
+    assert sorted(results) == [300, 400, 500]
+    for size, result in results.items():
+        assert result == train_bpe(input_path, size, ["<|endoftext|>"])
+
+
+def test_train_bpe_sharded_merge_loop(tmp_path, corpus_en_bpe):
+    input_path = FIXTURES_PATH / "corpus.en"
+    assert train_bpe(input_path, 500, ["<|endoftext|>"], merge_workers=3) == corpus_en_bpe
+    for engine in ("tuple", "numpy"):
+        with pytest.raises(ValueError):
+            train_bpe(input_path, 500, ["<|endoftext|>"], engine=engine, merge_workers=3)
+    with ShardedBPE(count_pre_tokens(input_path, {"<|endoftext|>"}), {"<|endoftext|>"}, 2) as bpe:
+        with pytest.raises(ValueError):
+            bpe.run(10, checkpoint_path=tmp_path / "bpe.ckpt")
+
+
+def test_chunk_boundaries_without_special_token():
+    """
+    corpus.en has no <|endoftext|>: it must still split into several chunks, at boundaries that do not
+    change the pre-token counts.
+    """
+    input_path = FIXTURES_PATH / "corpus.en"
+    with open(input_path, "rb") as f:
+        boundaries = find_chunk_boundaries(f, 8, [b"<|endoftext|>"])
+    assert len(boundaries) == 9
+
+    specials = {"<|endoftext|>"}
+    counts = Counter()
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        counts.update(_work_slice(input_path, start, end, specials))
+    assert counts == _work_slice(input_path, 0, os.path.getsize(input_path), specials)
+
+
+def test_train_bpe_work_queue(corpus_en_bpe):
+    input_path = FIXTURES_PATH / "corpus.en"
+    assert train_bpe(input_path, 500, ["<|endoftext|>"], chunk_bytes=8192, queue_depth=3) == corpus_en_bpe
+
+
+def test_train_bpe_stats(tmp_path):
+    input_path = FIXTURES_PATH / "corpus.en"
+    stats = TrainStats(profile_dir=str(tmp_path), sample_every=100)
+    _, merges = train_bpe(input_path, 500, ["<|endoftext|>"], stats=stats)
+    assert {"boundaries", "pre_tokenize", "reduce", "pair_counts", "merges"} <= stats.phases.keys()
+    assert stats.worker_busy
+    assert stats.merge_samples[-1][0] == len(merges)
+    assert (tmp_path / "merges.prof").exists()
+    assert list(tmp_path.glob("pretokenize-*.prof"))
+
+
+def test_train_bpe_memory_stats(corpus_en_bpe):
+    input_path = FIXTURES_PATH / "corpus.en"
+    stats = TrainStats(rss_interval=0.01, trace_merges=True)
+    assert train_bpe(input_path, 500, ["<|endoftext|>"], stats=stats) == corpus_en_bpe
+    assert stats.phase_rss["merges"] > 0
+    assert set(stats.worker_peak_rss) == set(stats.worker_busy)
+    assert len(stats.process_rss) >= 2
+    assert stats.merge_traced_peak > 0 and stats.merge_traced_top
+
+
+def test_bench_compare_to_baseline():
+    base = {"corpus": "corpus.en", "vocab_size": 500, "engine": "int",
+            "wall_s": 1.0, "merges_per_s": 1000.0, "pretokenize_mb_per_s": 10.0, "peak_rss_mb": 100.0}
+    same = dict(base, wall_s=1.1, peak_rss_mb=90.0)
+    slow = dict(base, wall_s=2.0, merges_per_s=500.0)
+    assert compare_to_baseline([same], [base]) == []
+    assert len(compare_to_baseline([slow], [base])) == 2
+    assert compare_to_baseline([dict(slow, vocab_size=1000)], [base]) == []
+
+
+def test_pre_token_strings_match_pat():
+    pat = regex.compile(PAT)
+    texts = [p.read_text(encoding="utf-8") for p in sorted(FIXTURES_PATH.glob("*.txt"))]
+    texts.append((FIXTURES_PATH / "corpus.en").read_text(encoding="utf-8"))
+    texts += ["naïve café 3.5　x", "he's  \n\n  déjà-vu\x85 ok", "١٢٣ abc\t  'll", "é", " x é y "]
+    for text in texts:
+        assert pre_token_strings(text) == pat.findall(text)
+
+
+def test_train_bpe_out_of_core(tmp_path, corpus_en_bpe):
+    input_path = FIXTURES_PATH / "corpus.en"
+    special_tokens = ["<|endoftext|>"]
+    # a budget of a few hundred pre-tokens per worker forces many spills
+    with count_pre_tokens(input_path, set(special_tokens), worker_memory=1 << 14,
+                          spill_dir=str(tmp_path), spill_memory=1 << 16) as counts:
+        assert isinstance(counts, SpilledCounts)
+        assert dict(counts.items()) == count_pre_tokens(input_path, set(special_tokens))
+    assert list(tmp_path.iterdir()) == []
+
+    spilled = train_bpe(input_path, 500, special_tokens, spill_dir=str(tmp_path), spill_memory=1 << 16)
+    assert spilled == corpus_en_bpe
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_train_bpe_approximate_counts(corpus_en_bpe):
+    input_path = FIXTURES_PATH / "corpus.en"
+    _, exact = corpus_en_bpe
+    # a capacity above the number of unique pre-tokens and min_freq=1 are exact
+    assert train_bpe(input_path, 500, ["<|endoftext|>"], max_pre_tokens=1 << 20)[1] == exact
+
+    stats = TrainStats()
+    _, approx = train_bpe(input_path, 500, ["<|endoftext|>"], min_freq=2, stats=stats)
+    assert stats.pruned_pre_tokens > 0
+    assert merge_divergence(exact, approx)["overlap"][1.0] > 0.5
+
+    # the cap is per job: with one worker there is one job, so it also bounds the merged table
+    stats = TrainStats()
+    _, approx = train_bpe(input_path, 500, ["<|endoftext|>"], max_pre_tokens=1000, stats=stats,
+                          pool=PoolConfig(workers=1))
+    assert stats.pre_tokens <= 1000
+    assert merge_divergence(exact, approx)["overlap"][1.0] > 0.5
+    assert merge_divergence(exact, exact) == {"first_difference": None, "overlap": dict.fromkeys(
+        (0.1, 0.25, 0.5, 1.0), 1.0), "mean_rank_shift": 0.0}
+
+
+def test_train_bpe_multi_file_inputs(tmp_path):
+    # corpus.en split at line boundaries into shards of very different sizes
+    lines = (FIXTURES_PATH / "corpus.en").read_bytes().splitlines(keepends=True)
+    shards = [lines[:20], lines[20:60], lines[60:]]
+    for i, shard in enumerate(shards):
+        (tmp_path / f"shard-{i}.txt").write_bytes(b"".join(shard))
+    (tmp_path / ".hidden").write_bytes(b"not corpus")
+    paths = resolve_inputs(tmp_path)
+    assert [p.name for p in paths] == ["shard-0.txt", "shard-1.txt", "shard-2.txt"]
+    assert resolve_inputs(str(tmp_path / "shard-*.txt")) == paths
+    assert resolve_inputs([paths[0], str(tmp_path / "shard-[12].txt")]) == paths
+
+    special = ["<|endoftext|>"]
+    expected = count_pre_tokens(paths[0], set(special))
+    for p in paths[1:]:
+        for word, count in count_pre_tokens(p, set(special)).items():
+            expected[word] = expected.get(word, 0) + count
+    assert count_pre_tokens(tmp_path, set(special)) == expected
+    assert count_pre_tokens(paths, set(special), chunk_bytes=4096) == expected
+
+    # small shards are batched into one job, large ones split
+    sizes = [p.stat().st_size for p in paths]
+    assert sizes[2] > 2 * (sizes[0] + sizes[1])
+    jobs = plan_jobs(paths, sizes[0] + sizes[1], [b"<|endoftext|>"])
+    assert [path for path, _, _ in jobs[0]] == [str(paths[0]), str(paths[1])]
+    assert len(jobs) > 2 and all(job == [(str(paths[2]), *job[0][1:])] for job in jobs[1:])
+    assert sum(end - start for job in jobs for _, start, end in job) == sum(sizes)
+
+    vocab, merges = train_bpe(str(tmp_path / "shard-*.txt"), 500, special)
+    assert train_bpe(paths, 500, special) == (vocab, merges)
+
+
+def test_train_bpe_compressed_inputs(tmp_path, corpus_en_bpe):
+    data = (FIXTURES_PATH / "corpus.en").read_bytes()
+    # members cut at arbitrary bytes, in the middle of words and UTF-8 sequences
+    cuts = [0, 777, 5001, 5002, 31337, len(data)]
+    pieces = [data[a:b] for a, b in zip(cuts, cuts[1:])]
+    files = {
+        "single.gz": gzip.compress(data),
+        "streams.xz": b"".join(lzma.compress(p) for p in pieces),
+        "streams.bz2": b"".join(bz2.compress(p) for p in pieces),
+    }
+    special = ["<|endoftext|>"]
+    expected = count_pre_tokens(FIXTURES_PATH / "corpus.en", set(special))
+    for name, blob in files.items():
+        (tmp_path / name).write_bytes(blob)
+        assert count_pre_tokens(tmp_path / name, set(special)) == expected
+        assert count_pre_tokens(tmp_path / name, set(special), chunk_bytes=4096) == expected
+    assert len(compressed_members(tmp_path / "single.gz")) == 1
+    assert len(compressed_members(tmp_path / "streams.xz")) == len(pieces)
+
+    assert train_bpe(str(tmp_path / "streams.xz"), 500, special) == corpus_en_bpe
+
+
+def test_train_bpe_document_sampling(tmp_path):
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    special = {"<|endoftext|>"}
+    expected = count_pre_tokens(input_path, special)
+    stats = TrainStats()
+    assert count_pre_tokens(input_path, special, sample=DocSample(every=1), stats=stats) == expected
+    assert stats.sampled_docs == stats.corpus_docs > 1
+    assert stats.sampled_bytes == stats.corpus_bytes == input_path.stat().st_size
+
+    # every other document from both offsets adds up to the whole corpus
+    halves = [count_pre_tokens(input_path, special, sample=DocSample(every=2, seed=seed), chunk_bytes=512)
+              for seed in (0, 1)]
+    assert {w: halves[0].get(w, 0) + halves[1].get(w, 0) for w in {*halves[0], *halves[1]}} == expected
+
+    sample = DocSample(fraction=0.5, seed=3)
+    stats = TrainStats()
+    vocab, merges = train_bpe(str(input_path), 300, list(special), sample=sample, stats=stats, cache_dir=tmp_path)
+    assert stats.sampled_docs == round(0.5 * stats.corpus_docs)
+    assert 0 < stats.sample_coverage < 1
+    assert train_bpe(str(input_path), 300, list(special), sample=sample, cache_dir=tmp_path) == (vocab, merges)
+    with pytest.raises(ValueError):
+        DocSample(every=2, fraction=0.5)
+
+
+def test_train_bpe_worker_pools(tmp_path, corpus_en_bpe):
+    assert available_cpus() >= 1
+    input_path = FIXTURES_PATH / "corpus.en"
+    special = ["<|endoftext|>"]
+    expected = count_pre_tokens(input_path, set(special))
+    for pool in (PoolConfig(backend="thread", workers=2), PoolConfig(workers=2, start_method="fork"),
+                 PoolConfig(workers=2, persistent=True)):
+        assert count_pre_tokens(input_path, set(special), chunk_bytes=16384, pool=pool) == expected
+    # the persistent pool is reused across calls
+    pool = PoolConfig(workers=2, persistent=True)
+    assert train_bpe(str(input_path), 500, special, pool=pool) == corpus_en_bpe
+    shutdown_pools()
+    with pytest.raises(ValueError):
+        PoolConfig(backend="thread", start_method="fork")
+
+    # threads share one process: no per-worker RSS, and no per-job profiles
+    stats = TrainStats()
+    count_pre_tokens(input_path, set(special), stats=stats, pool=PoolConfig(backend="thread", workers=2))
+    assert stats.worker_busy and not stats.worker_peak_rss
+    with pytest.raises(ValueError):
+        count_pre_tokens(input_path, set(special), stats=TrainStats(profile_dir=str(tmp_path)),
+                         pool=PoolConfig(backend="thread"))
+
+
+def test_toy_bpe_numpy_engine():
+    input_path = str(FIXTURES_PATH / "tinystories_sample.txt")
+    expected = toy_bpe(input_path, 400, ["<|endoftext|>"])
+    assert toy_bpe(input_path, 400, ["<|endoftext|>"], engine="numpy") == expected